@@ -1,8 +1,11 @@
 #!/usr/bin/env python3
 
+import os
+import signal
 import subprocess
 import sys
-import json
+import tempfile
+import threading
 import math
 from pathlib import Path
 from tqdm import tqdm
@@ -10,6 +13,7 @@ import concurrent.futures
 import argparse
 import shutil
 import logging
+from common import find_files, probe_videos, PROBE_CACHE_NAME
 
 # --- Configuration ---
 VIDEO_SOURCE_DIR = Path("/projects/source_videos_high_res")
@@ -18,61 +22,203 @@ OUTPUT_DIR = Path("/projects/01_source_frames")
 # We can use multiple CPU workers. This is safe and fast.
 MAX_WORKERS = 10 
 
+# Threads per ffmpeg process (decoder and filter graph). ffmpeg defaults
+# to one per core, which oversubscribes the CPU once MAX_WORKERS of them
+# run side by side, so the cores are split evenly between workers.
+FFMPEG_THREADS = max(1, (os.cpu_count() or 1) // MAX_WORKERS)
+
+# Workers when decoding on the GPU with --use_nvdec. The GPU has only one
+# or two NVDEC engines, so more parallel ffmpegs just queue up on them.
+NVDEC_WORKERS = 3
+
+# ffprobe is cheap and mostly waits on disk, so probe with more threads.
+PROBE_WORKERS = 16
+
+# An ffmpeg run is killed if it takes longer than this many seconds per
+# second of video (never less than FFMPEG_MIN_TIMEOUT).
+FFMPEG_TIMEOUT_FACTOR = 2
+FFMPEG_MIN_TIMEOUT = 600
+
 FRAMES_PER_SECOND = 1
 JPEG_QUALITY = 2
+
+VIDEO_EXTENSIONS = {".mp4", ".mov", ".m4v", ".avi", ".mkv", ".webm"}
+
+# Bytes read from ffmpeg's stdout pipe at a time
+PIPE_READ_SIZE = 1 << 20
+
+# Written into a video's frame folder once extraction finished cleanly,
+# so re-runs can skip it.
+DONE_MARKER = ".extracted"
 # --- End Configuration ---
 
+# JPEG start/end of image markers
+JPEG_SOI = b"\xff\xd8"
+JPEG_EOI = b"\xff\xd9"
+
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(message)s')
 
-def get_video_duration(video_path):
-    """Uses ffprobe to get the duration of a video."""
-    command = [
-        "ffprobe", "-v", "quiet", "-print_format", "json",
-        "-show_streams", str(video_path)
-    ]
+def nvdec_available():
+    """True if this ffmpeg build lists 'cuda' among its hardware decoders."""
     try:
-        result = subprocess.run(command, capture_output=True, text=True, check=True)
-        data = json.loads(result.stdout)
-        for stream in data.get("streams", []):
-            if stream.get("codec_type") == "video":
-                return float(stream.get("duration", 0.0))
+        result = subprocess.run(
+            ["ffmpeg", "-hide_banner", "-hwaccels"],
+            capture_output=True, text=True, check=True
+        )
     except Exception:
-        return 0.0
-    return 0.0
+        return False
+    return "cuda" in result.stdout.split()
 
-def process_video(video_file):
+def split_jpegs(stream):
     """
-    Uses ffmpeg (CPU-ONLY) to extract NATIVE resolution frames.
+    Yields each complete JPEG from an MJPEG byte stream, split on the
+    SOI/EOI markers. 0xFF bytes inside JPEG entropy data are always
+    stuffed (FF 00), so FF D9 only ever appears as the real end marker.
+    """
+    buf = bytearray()
+    scan_from = 0
+    while True:
+        chunk = stream.read1(PIPE_READ_SIZE)
+        if not chunk:
+            return
+        buf += chunk
+        while True:
+            # Resume where the last scan stopped instead of rescanning the
+            # whole partial frame after every read.
+            eoi = buf.find(JPEG_EOI, max(scan_from - 1, 2))
+            if eoi < 0:
+                scan_from = len(buf)
+                break
+            soi = buf.find(JPEG_SOI, 0, eoi)
+            if soi >= 0:
+                yield bytes(buf[soi:eoi + 2])
+            del buf[:eoi + 2]
+            scan_from = 0
+
+def already_extracted(video_output_folder, video_name):
+    """
+    True if a previous run finished this video: the done marker exists and
+    the last frame still ends with a JPEG end-of-image marker.
+    """
+    if not (video_output_folder / DONE_MARKER).exists():
+        return False
+    frames = sorted(video_output_folder.glob(f"{video_name}_frame_*.jpg"))
+    if not frames:
+        return False
+    try:
+        with open(frames[-1], 'rb') as f:
+            f.seek(-2, os.SEEK_END)
+            return f.read(2) == JPEG_EOI
+    except OSError:
+        return False
+
+def kill_on_timeout(proc, timed_out):
+    """Watchdog callback: records the timeout, then kills ffmpeg's process group."""
+    timed_out.set()
+    os.killpg(proc.pid, signal.SIGKILL)
+
+def process_video(video_file, duration, force=False, use_nvdec=False):
+    """
+    Uses ffmpeg to extract NATIVE resolution frames, decoding on the CPU.
     This is the robust, "tried and tested" method.
+    duration is the length in seconds already probed by main().
+    Videos already extracted by a previous run are skipped unless force is set.
+    With use_nvdec the video is decoded on the GPU instead; if that fails
+    (e.g. a codec or pixel format NVDEC can't handle) it is redone on the CPU.
     """
-    duration = get_video_duration(video_file)
+    video_name = video_file.stem
+    video_output_folder = OUTPUT_DIR / video_name
+
+    if not force and already_extracted(video_output_folder, video_name):
+        return f"  [SKIPPED] {video_name} (already extracted)"
+
     expected_frames = int(math.ceil(duration * FRAMES_PER_SECOND))
     tqdm.write(f"  [STARTING] {video_file.name} ({duration:.2f}s, expecting {expected_frames} frames)...")
 
-    video_name = video_file.stem
-    video_output_folder = OUTPUT_DIR / video_name
     video_output_folder.mkdir(parents=True, exist_ok=True)
+    (video_output_folder / DONE_MARKER).unlink(missing_ok=True)
 
-    output_pattern = video_output_folder / f"{video_name}_frame_%06d.jpg"
+    # Keep the first frame of every 1/FRAMES_PER_SECOND slice of the
+    # timeline with 'select' instead of resampling the whole stream with '-r'.
+    # Selecting by timestamp rather than frame number keeps the same
+    # sampling as '-r' on variable-frame-rate footage too.
+    # With NVDEC, frames stay on the GPU until after 'select', so only the
+    # kept ones are copied back for JPEG encoding.
+    download = ["hwdownload", "format=nv12", "format=yuvj420p"] if use_nvdec else []
+    select = (
+        f"select='isnan(prev_selected_t)"
+        f"+gt(floor(t*{FRAMES_PER_SECOND})\\,floor(prev_selected_t*{FRAMES_PER_SECOND}))'"
+    )
+    sampling = ["-vf", ",".join([select, *download]), "-vsync", "vfr"]
+    hwaccel = ["-hwaccel", "cuda", "-hwaccel_output_format", "cuda"] if use_nvdec else []
 
-    # --- THIS IS THE ROBUST CPU-ONLY COMMAND ---
-    # All '-hwaccel' flags have been removed.
+    # --- THIS IS THE ROBUST CPU-DECODE COMMAND ---
+    # '-hwaccel' is only added when --use_nvdec is asked for.
+    # One ffmpeg per video streams every frame as MJPEG over stdout; we
+    # split the stream here and name/write the frames ourselves.
     command = [
         "ffmpeg",
+        "-filter_threads", str(FFMPEG_THREADS),
+        "-threads", str(FFMPEG_THREADS),
+        *hwaccel,
         "-i", str(video_file),
-        "-r", str(FRAMES_PER_SECOND),
+        "-an", "-sn", "-dn",
+        *sampling,
         "-q:v", str(JPEG_QUALITY),
+        "-f", "image2pipe",
+        "-vcodec", "mjpeg",
         "-hide_banner",
         "-loglevel", "error",
-        str(output_pattern)
+        "pipe:1"
     ]
     # --- END OF FIX ---
 
-    try:
-        subprocess.run(command, check=True)
-        return f"  [DONE] Successfully processed {video_name}"
-    except Exception as e:
-        return f"  [ERROR] CPU processing failed for {video_file.name}: {e}"
+    # ffmpeg runs in its own session so it can be killed as a group on a
+    # timeout or Ctrl-C. stderr goes to a temp file so it can't fill its
+    # pipe and stall ffmpeg while we are busy reading stdout.
+    timeout = max(FFMPEG_MIN_TIMEOUT, duration * FFMPEG_TIMEOUT_FACTOR) if duration > 0 else None
+    with tempfile.TemporaryFile() as stderr_file:
+        try:
+            proc = subprocess.Popen(
+                command, stdout=subprocess.PIPE, stderr=stderr_file,
+                start_new_session=True
+            )
+        except Exception as e:
+            return f"  [ERROR] CPU processing failed for {video_file.name}: {e}"
+
+        timed_out = threading.Event()
+        watchdog = None
+        if timeout is not None:
+            watchdog = threading.Timer(timeout, kill_on_timeout, (proc, timed_out))
+            watchdog.start()
+
+        frame_count = 0
+        try:
+            for frame_count, jpeg in enumerate(split_jpegs(proc.stdout), start=1):
+                (video_output_folder / f"{video_name}_frame_{frame_count:06d}.jpg").write_bytes(jpeg)
+            proc.wait()
+        except BaseException:
+            # Ctrl-C never reaches ffmpeg in its own session, so kill it here
+            os.killpg(proc.pid, signal.SIGKILL)
+            proc.wait()
+            raise
+        finally:
+            if watchdog is not None:
+                watchdog.cancel()
+            proc.stdout.close()
+
+        if timed_out.is_set():
+            return f"  [ERROR] ffmpeg timed out after {timeout:.0f}s on {video_file.name}"
+        if proc.returncode != 0 and use_nvdec:
+            tqdm.write(f"  [NVDEC FAILED] {video_file.name}, retrying on the CPU...")
+            return process_video(video_file, duration, force=True, use_nvdec=False)
+        if proc.returncode != 0:
+            stderr_file.seek(0)
+            error = stderr_file.read().decode(errors="replace").strip()
+            return f"  [ERROR] CPU processing failed for {video_file.name}: ffmpeg exited with {proc.returncode}: {error}"
+
+    (video_output_folder / DONE_MARKER).write_text(f"{frame_count}\n")
+    return f"  [DONE] Successfully processed {video_name} ({frame_count} frames)"
 
 def main():
     parser = argparse.ArgumentParser(description="Extract native-res frames.")
@@ -80,8 +226,20 @@ def main():
         "--clean_output", action="store_true",
         help="Wipe the OUTPUT_DIR clean before starting."
     )
+    parser.add_argument(
+        "--force", action="store_true",
+        help="Re-extract videos even if a previous run already finished them."
+    )
+    parser.add_argument(
+        "--use_nvdec", action="store_true",
+        help=f"Decode on the GPU (NVDEC) with {NVDEC_WORKERS} workers. Falls back to the CPU per video on failure."
+    )
     args = parser.parse_args()
 
+    if args.use_nvdec and not nvdec_available():
+        print("Warning: this ffmpeg has no 'cuda' hwaccel. Using CPU decoding.")
+        args.use_nvdec = False
+
     if not VIDEO_SOURCE_DIR.is_dir():
         print(f"Error: Video source directory not found at {VIDEO_SOURCE_DIR}")
         return
@@ -93,29 +251,42 @@ def main():
     OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
 
     print(f"Scanning for videos in: {VIDEO_SOURCE_DIR}")
-    video_files = list(VIDEO_SOURCE_DIR.rglob("*.mp4")) + \
-                  list(VIDEO_SOURCE_DIR.rglob("*.mov")) + \
-                  list(VIDEO_SOURCE_DIR.rglob("*.m4v")) + \
-                  list(VIDEO_SOURCE_DIR.rglob("*.avi")) + \
-                  list(VIDEO_SOURCE_DIR.rglob("*.mkv")) + \
-                  list(VIDEO_SOURCE_DIR.rglob("*.webm"))
+    video_files = find_files(VIDEO_SOURCE_DIR, VIDEO_EXTENSIONS)
 
     if not video_files:
         print("No video files found. Exiting.")
         return
 
-    print(f"Found {len(video_files)} videos. Starting CPU-based frame extraction...")
+    print(f"Found {len(video_files)} videos. Probing durations...")
+    durations = probe_videos(video_files, OUTPUT_DIR / PROBE_CACHE_NAME, PROBE_WORKERS)
+
+    # Longest videos first, so short ones fill the tail instead of a long
+    # video starting last and leaving the other workers idle.
+    video_files.sort(key=lambda vf: durations[vf], reverse=True)
+
+    decoder = "NVDEC" if args.use_nvdec else "CPU"
+    print(f"Starting {decoder}-based frame extraction (longest videos first)...")
 
-    with concurrent.futures.ProcessPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        future_to_video = {executor.submit(process_video, vf): vf for vf in video_files}
+    workers = NVDEC_WORKERS if args.use_nvdec else MAX_WORKERS
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        future_to_video = {
+            executor.submit(process_video, vf, durations[vf], args.force, args.use_nvdec): vf
+            for vf in video_files
+        }
 
-        for future in tqdm(concurrent.futures.as_completed(future_to_video), total=len(video_files), desc="Extracting frames"):
-            video = future_to_video[future]
-            try:
-                result = future.result()
-                tqdm.write(result) # Print the [DONE] or [ERROR] message
-            except Exception as exc:
-                print(f'{video.name} generated an exception: {exc}')
+        try:
+            for future in tqdm(concurrent.futures.as_completed(future_to_video), total=len(video_files), desc="Extracting frames"):
+                video = future_to_video[future]
+                try:
+                    result = future.result()
+                    tqdm.write(result) # Print the [DONE] or [ERROR] message
+                except Exception as exc:
+                    print(f'{video.name} generated an exception: {exc}')
+        except KeyboardInterrupt:
+            # Don't start the queued videos; running workers kill their ffmpeg
+            print("\nInterrupted, cancelling remaining videos...")
+            executor.shutdown(wait=True, cancel_futures=True)
+            raise
 
     print("\n--- Native Frame Extraction Complete ---")
     print(f"All native frames are located in {OUTPUT_DIR}")
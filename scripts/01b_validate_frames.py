@@ -1,54 +1,59 @@
 #!/usr/bin/env python3
 
 import os
-import subprocess
-import json
 import math
 from pathlib import Path
 from tqdm import tqdm
 import logging
 import argparse
+import concurrent.futures
+import itertools
 from PIL import Image
+from common import find_files, list_files, probe_videos, PROBE_CACHE_NAME
 
 # --- Configuration ---
 FRAMES_PER_SECOND = 1.0 # Matches your Mac extraction script
+
+# Videos audited at once. The work is ffprobe plus small reads per frame,
+# which all wait on the disk, so threads are enough.
+AUDIT_WORKERS = 16
+
+VIDEO_EXTENSIONS = {".mp4", ".mov", ".m4v", ".avi", ".mkv", ".webm"}
+FRAME_EXTENSIONS = {".jpg"}
 # --- End Configuration ---
 
+# JPEG start/end of image markers
+JPEG_SOI = b"\xff\xd8"
+JPEG_EOI = b"\xff\xd9"
+
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(message)s')
 
-def get_video_info(video_path):
+def is_intact_jpeg(frame_path):
     """
-    Uses ffprobe to get duration.
-    Returns (duration_in_seconds)
+    Checks that a frame starts with a JPEG SOI marker and ends with an EOI
+    marker, reading only those 4 bytes. Catches empty and truncated files
+    without parsing the JPEG.
     """
-    command = [
-        "ffprobe",
-        "-v", "quiet",
-        "-print_format", "json",
-        "-show_streams",
-        str(video_path)
-    ]
+    fd = os.open(frame_path, os.O_RDONLY)
     try:
-        result = subprocess.run(command, capture_output=True, text=True, check=True)
-        data = json.loads(result.stdout)
-        for stream in data.get("streams", []):
-            if stream.get("codec_type") == "video":
-                return float(stream.get("duration", 0.0))
-    except Exception as e:
-        logging.warning(f"  WARN: Could not probe file {video_path.name}. Error: {e}")
-        return 0.0
-    return 0.0
+        size = os.fstat(fd).st_size
+        if size < 4:
+            return False
+        return os.pread(fd, 2, 0) == JPEG_SOI and os.pread(fd, 2, size - 2) == JPEG_EOI
+    finally:
+        os.close(fd)
 
-def validate_frames(frame_folder):
+def validate_frames(frame_folder, deep_verify=False):
     """
     Counts files and checks for corruption using a lightweight method.
+    With deep_verify, each frame is also checked by Pillow's verify().
     Returns (actual_frame_count, corrupt_frame_count)
     """
     if not frame_folder.is_dir():
         return 0, 0
     
     # We'll check for .jpg as that's what your Mac script outputs
-    frame_files = list(frame_folder.glob("*.jpg"))
+    frame_files = list_files(frame_folder, FRAME_EXTENSIONS)
     actual_count = len(frame_files)
     corrupt_count = 0
     
@@ -57,15 +62,15 @@ def validate_frames(frame_folder):
         
     for frame_path in frame_files:
         try:
-            # 1. Check for zero-byte files (very fast)
-            if frame_path.stat().st_size == 0:
+            # 1. Check for zero-byte or truncated files (4 bytes read)
+            if not is_intact_jpeg(frame_path):
                 corrupt_count += 1
                 continue
-                
-            # 2. Check for truncated/corrupt JPEG (fast, non-intensive)
-            # This is what you requested: a non-intensive check
-            with Image.open(frame_path) as img:
-                img.verify() # Reads header and metadata, but not pixel data
+
+            # 2. Optional header/metadata parse for paranoid runs
+            if deep_verify:
+                with Image.open(frame_path) as img:
+                    img.verify() # Reads header and metadata, but not pixel data
                 
         except Exception as e:
             # This catches zero-byte files and corrupt/truncated images
@@ -73,6 +78,43 @@ def validate_frames(frame_folder):
             
     return actual_count, corrupt_count
 
+def audit_video(video_path, duration, frame_output_dir, deep_verify=False):
+    """Validates one video's extracted frames against its duration and returns its report row."""
+    video_name = video_path.stem
+
+    if duration == 0:
+        return {
+            "video_name": video_path.name,
+            "duration": 0, "expected": 0, "actual": 0, "corrupt": 0,
+            "status": "Error: Could not read video"
+        }
+
+    # Use math.ceil, just like the original 01_extract.py script
+    expected_frames = int(math.ceil(duration * FRAMES_PER_SECOND))
+
+    frame_folder = frame_output_dir / video_name
+    actual_frames, corrupt_frames = validate_frames(frame_folder, deep_verify)
+
+    # Determine status
+    status = "OK"
+    if actual_frames == 0 and expected_frames > 0:
+        status = "Error: Missing extraction folder"
+    elif corrupt_frames > 0:
+        status = f"Error: Corrupt ({corrupt_frames} files)"
+    elif actual_frames != expected_frames:
+        diff = actual_frames - expected_frames
+        # Note: Your ffmpeg script might have a 1-frame-off issue
+        status = f"Warning: Mismatch (Expected {expected_frames}, Got {actual_frames}, Diff: {diff})"
+
+    return {
+        "video_name": video_path.name,
+        "duration": duration,
+        "expected": expected_frames,
+        "actual": actual_frames,
+        "corrupt": corrupt_frames,
+        "status": status
+    }
+
 def generate_html_report(report_data, output_path):
     """Generates the HTML report you requested."""
     
@@ -162,6 +204,10 @@ def main():
         required=True, 
         help="The base project directory (e.g., /projects/tara_tainton)"
     )
+    parser.add_argument(
+        "--deep_verify", action="store_true",
+        help="Also run Pillow's verify() on every frame (slower)."
+    )
     args = parser.parse_args()
     
     BASE_DIR = Path(args.base_dir)
@@ -179,14 +225,7 @@ def main():
         logging.error("This script requires the '01_source_frames' directory to exist.")
         return
 
-    video_files = sorted(
-        list(VIDEO_SOURCE_DIR.rglob("*.mp4")) + \
-        list(VIDEO_SOURCE_DIR.rglob("*.mov")) + \
-        list(VIDEO_SOURCE_DIR.rglob("*.m4v")) + \
-        list(VIDEO_SOURCE_DIR.rglob("*.avi")) + \
-        list(VIDEO_SOURCE_DIR.rglob("*.mkv")) + \
-        list(VIDEO_SOURCE_DIR.rglob("*.webm"))
-    )
+    video_files = sorted(find_files(VIDEO_SOURCE_DIR, VIDEO_EXTENSIONS))
     
     if not video_files:
         logging.error(f"No video files found in {VIDEO_SOURCE_DIR}")
@@ -194,45 +233,14 @@ def main():
         
     logging.info(f"Found {len(video_files)} videos. Auditing against {FRAME_OUTPUT_DIR}...")
     
-    report_data = []
+    durations = probe_videos(video_files, FRAME_OUTPUT_DIR / PROBE_CACHE_NAME, AUDIT_WORKERS)
 
-    for video_path in tqdm(video_files, desc="Validating Extractions"):
-        video_name = video_path.stem
-        duration = get_video_info(video_path)
-        
-        if duration == 0:
-            report_data.append({
-                "video_name": video_path.name,
-                "duration": 0, "expected": 0, "actual": 0, "corrupt": 0,
-                "status": "Error: Could not read video"
-            })
-            continue
-
-        # Use math.ceil, just like the original 01_extract.py script
-        expected_frames = int(math.ceil(duration * FRAMES_PER_SECOND))
-        
-        frame_folder = FRAME_OUTPUT_DIR / video_name
-        actual_frames, corrupt_frames = validate_frames(frame_folder)
-        
-        # Determine status
-        status = "OK"
-        if actual_frames == 0 and expected_frames > 0:
-            status = "Error: Missing extraction folder"
-        elif corrupt_frames > 0:
-            status = f"Error: Corrupt ({corrupt_frames} files)"
-        elif actual_frames != expected_frames:
-            diff = actual_frames - expected_frames
-            # Note: Your ffmpeg script might have a 1-frame-off issue
-            status = f"Warning: Mismatch (Expected {expected_frames}, Got {actual_frames}, Diff: {diff})"
-            
-        report_data.append({
-            "video_name": video_path.name,
-            "duration": duration,
-            "expected": expected_frames,
-            "actual": actual_frames,
-            "corrupt": corrupt_frames,
-            "status": status
-        })
+    with concurrent.futures.ThreadPoolExecutor(max_workers=AUDIT_WORKERS) as executor:
+        audits = executor.map(
+            audit_video, video_files, (durations[vf] for vf in video_files),
+            itertools.repeat(FRAME_OUTPUT_DIR), itertools.repeat(args.deep_verify)
+        )
+        report_data = list(tqdm(audits, total=len(video_files), desc="Validating Extractions"))
 
     logging.info(f"Validation complete. Generating report at {REPORT_FILE}...")
     generate_html_report(report_data, REPORT_FILE)
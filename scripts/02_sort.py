@@ -1,12 +1,21 @@
 #!/usr/bin/env python3
 
 import os
+import fcntl
 import shutil
 from pathlib import Path
 from ultralytics import YOLO
+import cv2
+import numpy as np
+from PIL import Image
 from tqdm import tqdm
 import torch
 import argparse # <-- 1. IMPORTED
+import concurrent.futures
+import multiprocessing
+import itertools
+import json
+from common import find_files, load_json_cache
 
 # --- Configuration ---
 # 2. Hard-coded paths are REMOVED
@@ -14,6 +23,35 @@ MODEL_NAME = 'yolov8l-pose.pt'
 CONF_THRESHOLD = 0.5
 DEVICE = 0
 
+# Each worker process loads its own copy of the model onto the GPU.
+# A few workers keep the GPU busy while the others do decode/NMS on the CPU.
+NUM_WORKERS = 3
+
+# YOLO letterboxes every input to 640px anyway, so shrink big frames
+# once up front instead of handing it full native-res arrays.
+INFERENCE_MAX_SIDE = 640
+
+# Frames handed to a worker at a time. Inside a worker, DECODE_THREADS
+# threads read and decode ahead while the model runs on the current frame.
+CHUNK_SIZE = 32
+DECODE_THREADS = 2
+
+# Decoded frames passed to the model per forward pass. One batched call
+# replaces INFERENCE_BATCH separate launches and host-to-device copies.
+INFERENCE_BATCH = 16
+
+# Run the model in FP16 on the GPU. Keypoint confidences are only compared
+# against CONF_THRESHOLD, so half precision doesn't change the sorting.
+HALF_PRECISION = True
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp"}
+
+# Keypoint confidences from earlier runs, keyed by frame path and
+# validated against (mtime_ns, size) and the model file that produced them.
+# Re-runs (e.g. after tuning CONF_THRESHOLD) only run inference on new or
+# changed frames.
+CACHE_NAME = ".keypoint_cache.json"
+
 KEYPOINT_NAMES = {
     0: 'nose', 1: 'left_eye', 2: 'right_eye', 3: 'left_ear', 4: 'right_ear',
     5: 'left_shoulder', 6: 'right_shoulder', 7: 'left_elbow', 8: 'right_elbow',
@@ -22,6 +60,216 @@ KEYPOINT_NAMES = {
 }
 # --- End Configuration ---
 
+KEYPOINT_INDEX = {name: i for i, name in KEYPOINT_NAMES.items()}
+
+# Keypoint indices for each body-part test, resolved once at import
+FACE_IDX = np.array([KEYPOINT_INDEX['nose'], KEYPOINT_INDEX['left_eye']])
+SHOULDER_IDX = np.array([KEYPOINT_INDEX['left_shoulder'], KEYPOINT_INDEX['right_shoulder']])
+HIP_IDX = np.array([KEYPOINT_INDEX['left_hip'], KEYPOINT_INDEX['right_hip']])
+ANKLE_IDX = np.array([KEYPOINT_INDEX['left_ankle'], KEYPOINT_INDEX['right_ankle']])
+
+# categorize_batch() result index -> category name
+POSE_CATEGORIES = ("face_and_hair", "upper_body", "full_body", "review_no_face", "uncategorized")
+
+# imread flags that let libjpeg decode straight at 1/8, 1/4 or 1/2 scale
+REDUCED_READS = (
+    (8, cv2.IMREAD_REDUCED_COLOR_8),
+    (4, cv2.IMREAD_REDUCED_COLOR_4),
+    (2, cv2.IMREAD_REDUCED_COLOR_2),
+)
+
+# ioctl request number for a reflink clone (linux/fs.h)
+FICLONE = 0x40049409
+
+# Set once per worker process by _init_worker()
+_MODEL = None
+_DECODER = None
+
+def _init_worker(model_path):
+    """Loads the YOLO model once per worker instead of once per image."""
+    global _MODEL, _DECODER
+    # Each worker would otherwise start an ncpu-sized OpenCV and torch
+    # thread pool, giving NUM_WORKERS * ncpu threads fighting for cores.
+    # Inference runs on the GPU, so one CPU thread per worker is plenty.
+    cv2.setNumThreads(1)
+    torch.set_num_threads(1)
+    _MODEL = YOLO(str(model_path), task="pose")
+    # An exported TensorRT engine is already bound to the GPU
+    if model_path.suffix == ".pt":
+        _MODEL.to(DEVICE)
+    _DECODER = concurrent.futures.ThreadPoolExecutor(max_workers=DECODE_THREADS)
+
+def place_file(src, dst_dir, copy=False):
+    """
+    Puts src into dst_dir without duplicating its bytes where possible:
+    hardlink first, then a reflink clone (Btrfs/XFS), then a real copy.
+    Hardlinks share the inode with the source frame, so downstream steps
+    must never modify sorted images in place (they only read them).
+    With copy=True, always makes a real, independent copy.
+    """
+    dst = dst_dir / src.name
+    if os.path.lexists(dst):
+        dst.unlink()
+    if copy:
+        shutil.copy(src, dst)
+        return
+    try:
+        os.link(src, dst)
+        return
+    except OSError:
+        pass
+    try:
+        with open(src, 'rb') as f_in, open(dst, 'wb') as f_out:
+            fcntl.ioctl(f_out.fileno(), FICLONE, f_in.fileno())
+        return
+    except OSError:
+        pass
+    shutil.copy(src, dst)
+
+def remove_stale_link(src, dst_dir):
+    """
+    Removes src's entry in dst_dir after its category changed on a re-run,
+    but only if it is a hardlink to src. Copies (--copy, reflinks) and
+    anything sorted by hand are left alone for the user to audit.
+    Returns True if the entry was removed.
+    """
+    dst = dst_dir / src.name
+    try:
+        if not os.path.samefile(src, dst):
+            return False
+        dst.unlink()
+    except OSError:
+        return False
+    return True
+
+def load_for_inference(img_path):
+    """Decodes an image (BGR) with its long side capped at INFERENCE_MAX_SIDE."""
+    # Only the header is read here, to pick the largest reduced decode that
+    # still leaves at least INFERENCE_MAX_SIDE pixels on the long side.
+    with Image.open(img_path) as header:
+        long_side = max(header.size)
+    flags = cv2.IMREAD_COLOR
+    for factor, reduced_flag in REDUCED_READS:
+        if long_side // factor >= INFERENCE_MAX_SIDE:
+            flags = reduced_flag
+            break
+
+    image = cv2.imread(str(img_path), flags)
+    if image is None:
+        raise ValueError("could not decode image")
+    h, w = image.shape[:2]
+    scale = INFERENCE_MAX_SIDE / max(h, w)
+    if scale < 1:
+        image = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    return image
+
+def try_load(img_path):
+    """Runs load_for_inference on a decode thread. Returns (image, error_message)."""
+    try:
+        return load_for_inference(img_path), None
+    except Exception as e:
+        return None, str(e)
+
+def classify_batch(img_paths, images):
+    """
+    Runs YOLO-Pose on a batch of decoded images in one forward pass, in a
+    worker process. Returns one (img_path, keypoint_confidences,
+    error_message) per image; the confidences are None when no person
+    was detected.
+    """
+    try:
+        results = _MODEL(
+            images, device=DEVICE, half=HALF_PRECISION,
+            imgsz=INFERENCE_MAX_SIDE, verbose=False
+        )
+    except Exception as e:
+        return [(img_path, None, str(e)) for img_path in img_paths]
+
+    # Stack the first person's confidences from every frame that has one
+    # and copy them off the GPU in one transfer, instead of one per frame.
+    has_person = [result.keypoints.shape[0] > 0 for result in results]
+    first_confs = [result.keypoints.conf[0] for result, found in zip(results, has_person) if found]
+    conf_rows = iter(torch.stack(first_confs).cpu().tolist() if first_confs else [])
+
+    return [
+        (img_path, next(conf_rows) if found else None, None)
+        for img_path, found in zip(img_paths, has_person)
+    ]
+
+def categorize_batch(confs_list):
+    """
+    Maps keypoint confidence lists (None = no person) to category names.
+    The whole batch is thresholded and classified as (B, 17) boolean masks.
+    """
+    names = ["no_person_detected"] * len(confs_list)
+    rows = [i for i, confs in enumerate(confs_list) if confs is not None]
+    if not rows:
+        return names
+
+    # One threshold over every confidence, then gather per body part
+    visible = np.asarray([confs_list[i] for i in rows]) > CONF_THRESHOLD
+    has_face = visible[:, FACE_IDX].all(axis=1)
+    has_shoulders = visible[:, SHOULDER_IDX].any(axis=1)
+    has_hips = visible[:, HIP_IDX].any(axis=1)
+    has_ankles = visible[:, ANKLE_IDX].any(axis=1)
+
+    # First matching rule wins, as in an if/elif chain
+    category = np.select(
+        [
+            has_face & has_shoulders & ~has_hips,
+            has_face & has_shoulders & has_hips & ~has_ankles,
+            has_face & has_shoulders & has_hips & has_ankles,
+            ~has_face & has_shoulders,
+        ],
+        [0, 1, 2, 3],
+        default=4,
+    )
+    for i, c in zip(rows, category.tolist()):
+        names[i] = POSE_CATEGORIES[c]
+    return names
+
+def classify_chunk(img_paths):
+    """
+    Classifies a chunk of images in a worker process. The decode threads
+    run ahead of inference, so disk reads and JPEG decoding overlap the GPU.
+    Decoded frames are inferred INFERENCE_BATCH at a time.
+    """
+    out = []
+    batch_paths, batch_images = [], []
+    for img_path, (image, error) in zip(img_paths, _DECODER.map(try_load, img_paths)):
+        if error is not None:
+            out.append((img_path, None, error))
+            continue
+        batch_paths.append(img_path)
+        batch_images.append(image)
+        if len(batch_images) == INFERENCE_BATCH:
+            out.extend(classify_batch(batch_paths, batch_images))
+            batch_paths, batch_images = [], []
+    if batch_images:
+        out.extend(classify_batch(batch_paths, batch_images))
+    return out
+
+def run_inference(image_files, model_path):
+    """Yields (img_path, keypoint_confidences, error_message) for each image, inferred in worker processes."""
+    if not image_files:
+        return
+
+    print(f"Loading model '{model_path.name}' in {NUM_WORKERS} worker processes...")
+
+    # 'spawn' is required: CUDA is already initialized in this process and
+    # cannot be re-initialized in a forked child.
+    mp_context = multiprocessing.get_context("spawn")
+
+    # Workers decode and run inference; the caller only links files into
+    # place, so placing one chunk overlaps inference on the next.
+    chunks = [image_files[i:i + CHUNK_SIZE] for i in range(0, len(image_files), CHUNK_SIZE)]
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=NUM_WORKERS, mp_context=mp_context,
+        initializer=_init_worker, initargs=(model_path,)
+    ) as executor:
+        for chunk_results in executor.map(classify_chunk, chunks):
+            yield from chunk_results
+
 def main():
     # 3. ADDED ARGUMENT PARSER
     parser = argparse.ArgumentParser(description="Sort frames using YOLO-Pose.")
@@ -31,6 +279,14 @@ def main():
         required=True, 
         help="The base project directory (e.g., /projects/tara_tainton)"
     )
+    parser.add_argument(
+        "--copy", action="store_true",
+        help="Copy frames into the category folders instead of hardlinking them."
+    )
+    parser.add_argument(
+        "--engine", action="store_true",
+        help="Run a TensorRT FP16 engine of the model (exported next to it on first use; needs TensorRT)."
+    )
     args = parser.parse_args()
 
     # 4. DEFINE PATHS RELATIVE TO base_dir
@@ -72,61 +328,73 @@ def main():
         print(f"\n*** FATAL ERROR: Model file not found at {MODEL_PATH} ***")
         print(f"Please ensure '{MODEL_NAME}' is in your base project directory: {BASE_DIR}")
         return
-        
-    print(f"Loading model '{MODEL_PATH.name}'...")
-    model = YOLO(str(MODEL_PATH)) # <-- Load from specific path
-    model.to(DEVICE)
-    print("Model loaded successfully.")
 
-    image_files = list(SOURCE_DIR.rglob("*.jpg")) + \
-                  list(SOURCE_DIR.rglob("*.jpeg")) + \
-                  list(SOURCE_DIR.rglob("*.png")) + \
-                  list(SOURCE_DIR.rglob("*.webp"))
+    if args.engine:
+        engine_path = MODEL_PATH.with_suffix(".engine")
+        if not engine_path.exists():
+            # Fixed 640px input, dynamic batch up to INFERENCE_BATCH
+            print(f"Exporting TensorRT FP16 engine to {engine_path} (one-time, takes a few minutes)...")
+            YOLO(str(MODEL_PATH)).export(
+                format="engine", half=True, imgsz=INFERENCE_MAX_SIDE,
+                dynamic=True, batch=INFERENCE_BATCH, device=DEVICE
+            )
+        MODEL_PATH = engine_path
+        
+    image_files = find_files(SOURCE_DIR, IMAGE_EXTENSIONS)
 
     if not image_files:
         print(f"\n*** FATAL ERROR: No images found in {SOURCE_DIR} ***")
         print("Did Phase 1 (extraction & validation) complete successfully?")
         return
 
-    print(f"Found {len(image_files)} images. Starting processing...")
-    
+    # Reuse keypoints for frames that have not changed since the last run
+    cache_path = OUTPUT_DIR / CACHE_NAME
+    old_cache = load_json_cache(cache_path)
+    new_cache = {}
+    stats = {}
+    cached, to_infer = [], []
+    for img_path in image_files:
+        st = img_path.stat()
+        stats[img_path] = [st.st_mtime_ns, st.st_size]
+        entry = old_cache.get(str(img_path))
+        if entry is not None and entry["stat"] == stats[img_path] and entry.get("model") == MODEL_PATH.name:
+            cached.append((img_path, entry["conf"], None))
+        else:
+            to_infer.append(img_path)
+
+    print(f"Found {len(image_files)} images ({len(cached)} cached, {len(to_infer)} to infer). Starting processing...")
+
     # --- This is the sorting logic ---
-    for img_path in tqdm(image_files, desc="Sorting image batch"):
-        try:
-            results = model(str(img_path), device=DEVICE, verbose=False)
-
-            if results[0].keypoints.shape[0] == 0:
-                shutil.copy(img_path, CATEGORIES["no_person_detected"])
-                continue
-
-            conf_tensor = results[0].keypoints.conf[0]
-            conf_map = {
-                KEYPOINT_NAMES[i]: conf_tensor[i].item() 
-                for i in range(len(KEYPOINT_NAMES))
-            }
-            get_conf = lambda name: conf_map.get(name, 0.0)
-
-            has_face = get_conf('nose') > CONF_THRESHOLD and get_conf('left_eye') > CONF_THRESHOLD
-            has_shoulders = get_conf('left_shoulder') > CONF_THRESHOLD or get_conf('right_shoulder') > CONF_THRESHOLD
-            has_hips = get_conf('left_hip') > CONF_THRESHOLD or get_conf('right_hip') > CONF_THRESHOLD
-            has_ankles = get_conf('left_ankle') > CONF_THRESHOLD or get_conf('right_ankle') > CONF_THRESHOLD
-
-            target_folder = None
-            if has_face and has_shoulders and not has_hips:
-                target_folder = CATEGORIES["face_and_hair"]
-            elif has_face and has_shoulders and has_hips and not has_ankles:
-                target_folder = CATEGORIES["upper_body"]
-            elif has_face and has_shoulders and has_hips and has_ankles:
-                target_folder = CATEGORIES["full_body"]
-            elif (not has_face) and has_shoulders:
-                target_folder = CATEGORIES["review_no_face"]
-            else:
-                target_folder = CATEGORIES["uncategorized"]
-
-            shutil.copy(img_path, target_folder)
-
-        except Exception as e:
-            tqdm.write(f"Error on {img_path.name}: {e}")
+    # Results are categorized CHUNK_SIZE at a time
+    results = itertools.chain(cached, run_inference(to_infer, MODEL_PATH))
+    with tqdm(total=len(image_files), desc="Sorting image batch") as pbar:
+        while batch := list(itertools.islice(results, CHUNK_SIZE)):
+            inferred = []
+            for img_path, confs, error in batch:
+                if error is not None:
+                    tqdm.write(f"Error on {img_path.name}: {error}")
+                else:
+                    inferred.append((img_path, confs))
+
+            categories = categorize_batch([confs for _, confs in inferred])
+            for (img_path, confs), category in zip(inferred, categories):
+                new_cache[str(img_path)] = {
+                    "stat": stats[img_path], "model": MODEL_PATH.name,
+                    "conf": confs, "category": category
+                }
+                # A re-run may move a frame to another category; unlink the
+                # old placement so it is not masked twice downstream
+                old_category = old_cache.get(str(img_path), {}).get("category")
+                if old_category not in (None, category) and old_category in CATEGORIES:
+                    if not remove_stale_link(img_path, CATEGORIES[old_category]):
+                        tqdm.write(f"Note: {img_path.name} moved from {old_category} to {category}; old copy kept for review")
+                try:
+                    place_file(img_path, CATEGORIES[category], args.copy)
+                except Exception as e:
+                    tqdm.write(f"Error on {img_path.name}: {e}")
+            pbar.update(len(batch))
+
+    cache_path.write_text(json.dumps(new_cache))
 
     print("\n--- Phase 2 Sorting Complete ---")
     print(f"Sorted images are in: {OUTPUT_DIR}")
@@ -6,30 +6,79 @@ import logging
 import argparse
 import random
 import cv2
+from PIL import Image
 from tqdm import tqdm
+import concurrent.futures
+import json
+from common import list_files, load_json_cache
 
 # --- Configuration ---
 RANDOM_SAMPLE_SIZE = 100 # Show this many random images
 TOP_N_SHARPEST = 100     # Show this many sharpest images
+
+# Sharpness scoring runs one process per core; each worker is handed
+# SCORE_CHUNK_SIZE images at a time to keep the pickling overhead low.
+NUM_WORKERS = os.cpu_count()
+SCORE_CHUNK_SIZE = 16
+
+# Frames are shrunk to this long side before scoring. The score only ranks
+# rejects against each other, and Laplacian cost scales with pixel count.
+SHARPNESS_MAX_SIDE = 512
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png"}
+
+# Sharpness scores from earlier runs, keyed by image path and validated
+# against (mtime_ns, size) and SHARPNESS_MAX_SIDE. Re-runs only score new
+# or changed rejects.
+CACHE_NAME = ".sharpness_cache.json"
 # --- End Configuration ---
 
+# imread flags that let libjpeg decode straight to grayscale at 1/8, 1/4
+# or 1/2 scale
+REDUCED_GRAY_READS = (
+    (8, cv2.IMREAD_REDUCED_GRAYSCALE_8),
+    (4, cv2.IMREAD_REDUCED_GRAYSCALE_4),
+    (2, cv2.IMREAD_REDUCED_GRAYSCALE_2),
+)
+
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+def _init_worker():
+    """Keeps each worker to one OpenCV thread so NUM_WORKERS processes don't oversubscribe the cores."""
+    cv2.setNumThreads(1)
+
 def get_sharpness_score(image_path):
-    """Calculates a global sharpness score for an image."""
+    """
+    Calculates a global sharpness score for an image (at SHARPNESS_MAX_SIDE).
+    Returns None if the image can't be read, so it is retried next run.
+    """
     try:
-        image = cv2.imread(str(image_path))
-        if image is None:
-            return 0.0
-        image_gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        return cv2.Laplacian(image_gray, cv2.CV_64F).var()
+        # Only the header is read here, to pick the largest reduced decode
+        # that still leaves at least SHARPNESS_MAX_SIDE on the long side.
+        with Image.open(image_path) as header:
+            long_side = max(header.size)
+        flags = cv2.IMREAD_GRAYSCALE
+        for factor, reduced_flag in REDUCED_GRAY_READS:
+            if long_side // factor >= SHARPNESS_MAX_SIDE:
+                flags = reduced_flag
+                break
+
+        image_gray = cv2.imread(str(image_path), flags)
+        if image_gray is None:
+            return None
+        scale = SHARPNESS_MAX_SIDE / max(image_gray.shape)
+        if scale < 1:
+            image_gray = cv2.resize(image_gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        # float32 holds a uint8 Laplacian exactly; variance = stddev^2
+        _, stddev = cv2.meanStdDev(cv2.Laplacian(image_gray, cv2.CV_32F))
+        return float(stddev[0, 0]) ** 2
     except Exception:
-        return 0.0
+        return None
 
 def generate_html_report(random_sample, sharpest_sample, output_path, base_project_dir):
     """Generates the HTML report for rejected files."""
     
-    html = f"""
+    parts = [f"""
     <html><head><title>Reject Bin QA Report</title>
     <style>
         body {{ font-family: sans-serif; background: #222; color: #eee; margin: 20px; }}
@@ -59,34 +108,34 @@ def generate_html_report(random_sample, sharpest_sample, output_path, base_proje
     <div class='category'>
         <h2>Control 1: Random Sample (Sample of {len(random_sample)})</h2>
         <div class='item-grid'>
-    """
+    """]
     
     for img_path in random_sample:
         try:
             rel_path = img_path.relative_to(base_project_dir)
         except ValueError:
             rel_path = img_path
-        html += f"""
+        parts.append(f"""
         <div class='item'>
             <img src='{rel_path}' alt='{img_path.name}' loading='lazy'>
             <p><b>File:</b> {img_path.name}</p>
         </div>
-        """
-    html += "</div></div>" # End item-grid and category
+        """)
+    parts.append("</div></div>") # End item-grid and category
 
     # --- Section 2: Top N Sharpest ---
-    html += f"""
+    parts.append(f"""
     <div class='category'>
         <h2>Control 2: Top {len(sharpest_sample)} Sharpest (False Negative Finder)</h2>
         <div class='item-grid'>
-    """
+    """)
     
     for score, img_path in sharpest_sample:
         try:
             rel_path = img_path.relative_to(base_project_dir)
         except ValueError:
             rel_path = img_path
-        html += f"""
+        parts.append(f"""
         <div class='item'>
             <img src='{rel_path}' alt='{img_path.name}' loading='lazy'>
             <p>
@@ -94,13 +143,13 @@ def generate_html_report(random_sample, sharpest_sample, output_path, base_proje
                 <span class='sharp-score'>Sharpness: {score:.0f}</span>
             </p>
         </div>
-        """
-    html += "</div></div>" # End item-grid and category
+        """)
+    parts.append("</div></div>") # End item-grid and category
 
-    html += "</div></body></html>"
+    parts.append("</div></body></html>")
     
     try:
-        output_path.write_text(html)
+        output_path.write_text("".join(parts))
         logging.info(f"Successfully generated report at {output_path}")
     except Exception as e:
         logging.error(f"Error writing HTML report: {e}")
@@ -127,9 +176,7 @@ def main():
 
     logging.info("--- Starting Step 2b: Reject Bin QA Report Generator ---")
     
-    all_rejects = list(REJECT_DIR.glob("*.jpg")) + \
-                    list(REJECT_DIR.glob("*.jpeg")) + \
-                    list(REJECT_DIR.glob("*.png"))
+    all_rejects = list_files(REJECT_DIR, IMAGE_EXTENSIONS)
 
     if not all_rejects:
         logging.warning(f"No rejected images found in {REJECT_DIR}. Nothing to do.")
@@ -145,11 +192,39 @@ def main():
         random_sample = random.sample(all_rejects, RANDOM_SAMPLE_SIZE)
     
     # --- 2. Control 2: Top N Sharpest ---
-    logging.info("Scoring all rejected images for sharpness (this may take a moment)...")
-    all_scores = []
-    for img_path in tqdm(all_rejects, desc="Scoring rejects"):
-        score = get_sharpness_score(img_path)
-        all_scores.append((score, img_path))
+    # Reuse scores for rejects that have not changed since the last run
+    cache_path = BASE_DIR / CACHE_NAME
+    old_cache = load_json_cache(cache_path)
+    new_cache = {}
+    stats = {}
+    all_scores, to_score = [], []
+    for img_path in all_rejects:
+        st = img_path.stat()
+        stats[img_path] = [st.st_mtime_ns, st.st_size]
+        entry = old_cache.get(str(img_path))
+        if entry is not None and entry["stat"] == stats[img_path] and entry["max_side"] == SHARPNESS_MAX_SIDE:
+            all_scores.append((entry["score"], img_path))
+        else:
+            to_score.append(img_path)
+
+    logging.info(f"Scoring {len(to_score)} rejected images for sharpness ({len(all_scores)} cached)...")
+    if to_score:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=NUM_WORKERS, initializer=_init_worker) as executor:
+            scores = executor.map(get_sharpness_score, to_score, chunksize=SCORE_CHUNK_SIZE)
+            all_scores.extend(zip(tqdm(scores, total=len(to_score), desc="Scoring rejects"), to_score))
+
+    # Unreadable images are neither ranked nor cached
+    unreadable = [img_path for score, img_path in all_scores if score is None]
+    for img_path in unreadable:
+        logging.warning(f"Could not read {img_path} for sharpness scoring.")
+    all_scores = [(score, img_path) for score, img_path in all_scores if score is not None]
+
+    for score, img_path in all_scores:
+        new_cache[str(img_path)] = {"stat": stats[img_path], "max_side": SHARPNESS_MAX_SIDE, "score": score}
+    try:
+        cache_path.write_text(json.dumps(new_cache))
+    except OSError as e:
+        logging.warning(f"Could not write sharpness cache {cache_path}: {e}")
         
     # Sort by score, highest to lowest
     all_scores.sort(key=lambda x: x[0], reverse=True)
@@ -1,14 +1,16 @@
 #!/usr/bin/env python3
 
-import os
 from pathlib import Path
 from tqdm import tqdm
 import logging
 import argparse
 import random
+from common import list_files
 
 # --- Configuration ---
 SAMPLE_SIZE = 100 # Show this many random images per category
+
+ORIGINAL_EXTENSIONS = {".jpg", ".jpeg"}
 # --- End Configuration ---
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -16,7 +18,7 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 def generate_html_report(comparison_data, output_path, base_project_dir):
     """Generates the HTML report for side-by-side comparison."""
     
-    html = f"""
+    parts = [f"""
     <html><head><title>Masking QA Report (Side-by-Side)</title>
     <style>
         body {{ font-family: sans-serif; background: #222; color: #eee; margin: 20px; }}
@@ -54,14 +56,14 @@ def generate_html_report(comparison_data, output_path, base_project_dir):
     </head><body>
     <div class="container">
     <h1>Masking QA Report (Side-by-Side)</h1>
-    """
+    """]
     
     for category, items in comparison_data.items():
-        html += f"<div class='category'><h2>Category: {category} (Sample of {len(items)})</h2>"
-        html += "<div class='item-grid'>"
+        parts.append(f"<div class='category'><h2>Category: {category} (Sample of {len(items)})</h2>")
+        parts.append("<div class='item-grid'>")
         
         for item in items:
-            html += f"""
+            parts.append(f"""
             <div class='item'>
                 <div class='image-pair'>
                     <img src='{item['original_rel_path']}' alt='Original'>
@@ -69,14 +71,14 @@ def generate_html_report(comparison_data, output_path, base_project_dir):
                 </div>
                 <p><b>File:</b> {item['filename']}</p>
             </div>
-            """
+            """)
         
-        html += "</div></div>" # End item-grid and category
+        parts.append("</div></div>") # End item-grid and category
     
-    html += "</div></body></html>"
+    parts.append("</div></body></html>")
     
     try:
-        output_path.write_text(html)
+        output_path.write_text("".join(parts))
         logging.info(f"Successfully generated report at {output_path}")
     except Exception as e:
         logging.error(f"Error writing HTML report: {e}")
@@ -124,8 +126,7 @@ def main():
             continue
             
         # Find all the *original* files (JPEGs)
-        original_files = list(original_cat_dir.glob("*.jpg")) + \
-                         list(original_cat_dir.glob("*.jpeg"))
+        original_files = list_files(original_cat_dir, ORIGINAL_EXTENSIONS)
         
         if not original_files:
             logging.warning(f"No original JPG/JPEG files found in {original_cat_dir}")
@@ -1,14 +1,17 @@
 #!/usr/bin/env python3
 
-import os
 from pathlib import Path
 from shutil import rmtree, copy2
 from tqdm import tqdm
-from rembg import remove # This uses the default 'u2net' model
+from rembg import remove, new_session
 from PIL import Image
+import numpy as np
 import random
-import io
 import logging
+import queue
+import threading
+import concurrent.futures
+from common import list_files, prefetch, load_input
 
 # --- Configuration ---
 BASE_PROJECT_DIR = Path("/projects")
@@ -24,10 +27,61 @@ SOURCE_FOLDERS = [
 
 # 2. (FIXED) The clean output folder
 OUTPUT_DIR = BASE_PROJECT_DIR / "04_final_dataset"
+
+# One rembg session is created up front and reused for every image, on the
+# GPU when onnxruntime-gpu can use it.
+REMBG_MODEL = "u2net"
+ONNX_PROVIDERS = ["CUDAExecutionProvider", "CPUExecutionProvider"]
+
+# Threads reading and decoding input images ahead of the model
+READ_THREADS = 4
+# Max images read and decoded ahead of the model at once
+READ_AHEAD = READ_THREADS * 2
+
+# Max finished images waiting to be JPEG-encoded by the writer thread
+WRITE_QUEUE_SIZE = 16
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp"}
 # --- End Configuration ---
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+def alpha_blend(foreground, background):
+    """
+    Composites an RGBA foreground over an RGB background (PIL image or
+    array) of the same size in one numpy pass. Returns an RGB PIL image.
+    """
+    fg = np.asarray(foreground)
+    alpha = fg[..., 3:4].astype(np.uint16)
+    # uint16 is enough: 255 * 255 + 127 still fits. +127 rounds like PIL.
+    blended = (fg[..., :3] * alpha + np.asarray(background) * (255 - alpha) + 127) // 255
+    return Image.fromarray(blended.astype(np.uint8))
+
+def report_error(img_path, error):
+    """Prints a processing error, calling out the known Pillow _idat corruption."""
+    if "_idat" in str(error):
+        tqdm.write(f"SKIPPED (Pillow error): {img_path.name}. This image may be corrupt.")
+    else:
+        tqdm.write(f"Error processing {img_path.name}: {error}")
+
+def write_outputs(write_queue):
+    """
+    Writer thread: JPEG-encodes and saves composited images (plus their
+    caption files) so the main loop can start rembg on the next image.
+    Stops when it receives None.
+    """
+    while True:
+        job = write_queue.get()
+        if job is None:
+            break
+        image, output_filename, txt_path, txt_output = job
+        try:
+            image.save(output_filename, "JPEG", quality=95)
+            if txt_path.exists():
+                copy2(txt_path, txt_output)
+        except Exception as e:
+            tqdm.write(f"Error writing {output_filename.name}: {e}")
+
 def main():
     logging.info("--- Starting Phase 4: FAST Background Replacement (Collage) ---")
 
@@ -39,11 +93,21 @@ def main():
         Image.MAX_IMAGE_PIXELS = None 
         collage_pil = Image.open(COLLAGE_FILE).convert("RGB")
         collage_w, collage_h = collage_pil.size
+        # Converted once; random crops are then zero-copy slices of it
+        collage_np = np.asarray(collage_pil)
         logging.info(f"Collage loaded successfully ({collage_w}x{collage_h}).")
     except Exception as e:
         logging.error(f"*** FATAL ERROR: Could not load collage image. Error: {e} ***")
         return
 
+    logging.info(f"Loading rembg model '{REMBG_MODEL}'...")
+    session = new_session(REMBG_MODEL, providers=ONNX_PROVIDERS)
+    reader = concurrent.futures.ThreadPoolExecutor(max_workers=READ_THREADS)
+
+    write_queue = queue.Queue(maxsize=WRITE_QUEUE_SIZE)
+    writer = threading.Thread(target=write_outputs, args=(write_queue,), daemon=True)
+    writer.start()
+
     for source_folder in SOURCE_FOLDERS:
         if not source_folder.is_dir():
             logging.warning(f"Source folder {source_folder} not found. Skipping.")
@@ -67,23 +131,20 @@ def main():
             rmtree(output_folder)
         output_folder.mkdir(parents=True, exist_ok=True)
 
-        image_files = list(source_folder.glob("*.jpg")) + \
-                      list(source_folder.glob("*.jpeg")) + \
-                      list(source_folder.glob("*.png")) + \
-                      list(source_folder.glob("*.webp"))
+        image_files = list_files(source_folder, IMAGE_EXTENSIONS)
 
         if not image_files:
             logging.warning("No images found in this folder. Skipping.")
             continue
 
-        for img_path in tqdm(image_files, desc=f"Replacing backgrounds in {source_folder.name}"):
+        # The reader threads run a few images ahead, so reads and decodes overlap inference
+        inputs = prefetch(reader, load_input, image_files, READ_AHEAD)
+        for img_path, (input_image, error) in tqdm(zip(image_files, inputs), total=len(image_files), desc=f"Replacing backgrounds in {source_folder.name}"):
+            if error is not None:
+                report_error(img_path, error)
+                continue
             try:
-                with open(img_path, 'rb') as f_in:
-                    input_bytes = f_in.read()
-
-                output_bytes = remove(input_bytes)
-
-                foreground = Image.open(io.BytesIO(output_bytes)).convert("RGBA")
+                foreground = remove(input_image, session=session).convert("RGBA")
                 img_w, img_h = foreground.size
 
                 if img_w > collage_w or img_h > collage_h:
@@ -91,24 +152,22 @@ def main():
                 else:
                     rand_x = random.randint(0, collage_w - img_w)
                     rand_y = random.randint(0, collage_h - img_h)
-                    background_crop = collage_pil.crop((rand_x, rand_y, rand_x + img_w, rand_y + img_h))
+                    background_crop = collage_np[rand_y:rand_y + img_h, rand_x:rand_x + img_w]
 
-                new_image = Image.new("RGB", (img_w, img_h))
-                new_image.paste(background_crop, (0, 0))
-                new_image.paste(foreground, (0, 0), foreground)
+                new_image = alpha_blend(foreground, background_crop)
 
+                # JPEG encode and caption copy happen on the writer thread
                 output_filename = output_folder / f"{img_path.name}"
-                new_image.save(output_filename, "JPEG", quality=95)
-
                 txt_path = img_path.with_suffix(".txt")
-                if txt_path.exists():
-                    copy2(txt_path, output_folder / txt_path.name)
+                write_queue.put((new_image, output_filename, txt_path, output_folder / txt_path.name))
 
             except Exception as e:
-                if "_idat" in str(e):
-                    tqdm.write(f"SKIPPED (Pillow error): {img_path.name}. This image may be corrupt.")
-                else:
-                    tqdm.write(f"Error processing {img_path.name}: {e}")
+                report_error(img_path, e)
+
+    # Let the writer drain its queue before we report completion
+    reader.shutdown()
+    write_queue.put(None)
+    writer.join()
 
     logging.info("\n--- Phase 4 Complete ---")
     logging.info("FAST background replacement finished.")
@@ -3,10 +3,10 @@
 import cv2
 import numpy as np
 import os
+import fcntl
 import json
 import math
 import re
-import imagehash
 from pathlib import Path
 from shutil import copy2, rmtree
 from tqdm import tqdm
@@ -15,6 +15,10 @@ from ultralytics import YOLO
 import torch
 from PIL import Image
 import argparse
+import concurrent.futures
+import itertools
+import multiprocessing
+from common import list_files, find_files
 
 # --- Configuration ---
 WEIGHTS = {
@@ -33,6 +37,19 @@ INTRA_SOURCE_HASH_THRESHOLD = 10
 MODEL_NAME = 'yolov8l-pose.pt'
 DEVICE = 0 
 
+# Each worker process loads its own copy of the model onto the GPU and
+# does its own decode/mask/sharpness work on the CPU.
+NUM_WORKERS = 3
+
+# YOLO letterboxes every input to 640px anyway, so shrink big frames
+# once up front instead of handing it full native-res arrays.
+INFERENCE_MAX_SIDE = 640
+
+# Frames handed to a worker at a time. Inside a worker, DECODE_THREADS
+# threads read and decode ahead while the current frame is scored.
+CHUNK_SIZE = 16
+DECODE_THREADS = 2
+
 # --- QA FILTERS ---
 # "Ottoman" Test: Max allowed separate large objects
 MAX_CONTOUR_COUNT = 3
@@ -42,72 +59,194 @@ MAX_CONTOUR_COUNT = 3
 MIN_SHARPNESS_THRESHOLD = 50.0
 # --- END NEW FILTER ---
 
+# --- GPU SHARPNESS ---
+# Run the sharpness Laplacian on the GPU when OpenCV was built with CUDA
+# and a device is visible. The pip opencv-python wheels have no CUDA, so
+# there (or if the GPU path fails) the CPU Laplacian is used instead.
+USE_CUDA_LAPLACIAN = True
+
 KEYPOINT_NAMES = {
     0: 'nose', 1: 'left_eye', 2: 'right_eye', 3: 'left_ear', 4: 'right_ear',
     5: 'left_shoulder', 6: 'right_shoulder', 7: 'left_elbow', 8: 'right_elbow',
     9: 'left_wrist', 10: 'right_wrist', 11: 'left_hip', 12: 'right_hip',
     13: 'left_knee', 14: 'right_knee', 15: 'left_ankle', 16: 'right_ankle'
 }
+
+SOURCE_FRAME_EXTENSIONS = {".jpg", ".jpeg"}
+MASKED_EXTENSIONS = {".png"}
 # --- End Configuration ---
 
+# pHash: the top-left 8x8 of a 32x32 DCT. cv2.dct is orthonormal, which
+# shrinks the first row and column by sqrt(2) relative to the unnormalized
+# DCT imagehash uses; undo that so the median split (and the hash
+# thresholds above) behave the same.
+PHASH_SIZE = 32
+PHASH_LOW_FREQ = 8
+PHASH_DCT_SCALE = np.ones((PHASH_LOW_FREQ, PHASH_LOW_FREQ), dtype=np.float32)
+PHASH_DCT_SCALE[0, :] *= np.sqrt(2)
+PHASH_DCT_SCALE[:, 0] *= np.sqrt(2)
+
+# Set-bit count of every byte value, for popcount64() on numpy < 2
+POPCOUNT_8 = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
 FACE_KEYPOINTS = ['nose', 'left_eye', 'right_eye', 'left_ear', 'right_ear']
 UPPER_BODY_KEYPOINTS = FACE_KEYPOINTS + ['left_shoulder', 'right_shoulder', 'left_hip', 'right_hip']
 FULL_BODY_KEYPOINTS = list(KEYPOINT_NAMES.values())
+KEYPOINT_INDEX = {name: i for i, name in KEYPOINT_NAMES.items()}
 
-def get_source_video(filename):
+# Keypoint indices averaged by get_pose_score, resolved once at import
+POSE_SCORE_INDICES = {
+    "face_and_hair": np.array([KEYPOINT_INDEX[n] for n in FACE_KEYPOINTS]),
+    "upper_body": np.array([KEYPOINT_INDEX[n] for n in UPPER_BODY_KEYPOINTS]),
+    "full_body": np.array([KEYPOINT_INDEX[n] for n in FULL_BODY_KEYPOINTS]),
+}
+
+# ioctl request number for a reflink clone (linux/fs.h)
+FICLONE = 0x40049409
+
+# Set once per worker process by _init_worker()
+_MODEL = None
+_DECODER = None
+
+# Laplacian output buffer, reused for every frame of the same size so
+# each worker doesn't allocate a fresh full-res float image per frame.
+_LAPLACIAN_SCRATCH = None
+
+# Per-worker GPU Laplacian state, set by _init_worker() only when OpenCV
+# was built with CUDA and a device is visible. None means the CPU path.
+_CUDA_LAPLACIAN = None
+
+def _init_cuda_laplacian():
+    """
+    Builds the reusable GpuMats and Laplacian filter for get_sharpness_score.
+    The pip opencv-python wheels have no CUDA, so this returns None there.
+    """
+    if not USE_CUDA_LAPLACIAN:
+        return None
     try:
-        return filename.split("_frame_")[0]
-    except IndexError:
-        return "unknown_source"
+        if not cv2.cuda.getCudaEnabledDeviceCount() > 0:
+            return None
+        # The CUDA Laplacian only supports dst of the same type as src, so
+        # the frame is converted to float32 on the GPU first. ksize=1 and
+        # the default border match cv2.Laplacian on the CPU path.
+        return {
+            "filter": cv2.cuda.createLaplacianFilter(cv2.CV_32FC1, cv2.CV_32FC1, ksize=1),
+            "gray": cv2.cuda_GpuMat(),
+            "gray_f32": cv2.cuda_GpuMat(),
+            "laplacian": cv2.cuda_GpuMat(),
+        }
+    except (AttributeError, cv2.error):
+        return None
+
+def _init_worker(model_path):
+    """Loads the YOLO model once per worker instead of once per image."""
+    global _MODEL, _DECODER, _CUDA_LAPLACIAN
+    # Keep each worker to one OpenCV/torch CPU thread so NUM_WORKERS
+    # processes don't oversubscribe the cores.
+    cv2.setNumThreads(1)
+    torch.set_num_threads(1)
+    _MODEL = YOLO(str(model_path))
+    _MODEL.to(DEVICE)
+    _DECODER = concurrent.futures.ThreadPoolExecutor(max_workers=DECODE_THREADS)
+    _CUDA_LAPLACIAN = _init_cuda_laplacian()
+
+def place_file(src, dst):
+    """
+    Puts src at dst without duplicating its bytes where possible:
+    hardlink first, then a reflink clone (Btrfs/XFS), then a real copy.
+    Only used for the staged PNGs, which must never be modified in place
+    since a hardlink shares the inode with the masked original. Captions
+    are hand-edited, so they are always copied.
+    """
+    try:
+        os.link(src, dst)
+        return
+    except OSError:
+        pass
+    try:
+        with open(src, 'rb') as f_in, open(dst, 'wb') as f_out:
+            fcntl.ioctl(f_out.fileno(), FICLONE, f_in.fileno())
+        return
+    except OSError:
+        pass
+    copy2(src, dst)
+
+# Compiled once; get_frame_index runs for every source frame in Pass 0
+_FRAME_RE = re.compile(r'_frame_(\d+)\.(?:jpg|jpeg|png|webp)$', re.IGNORECASE)
+
+def get_source_video(filename):
+    return filename.partition("_frame_")[0]
 
 def get_frame_index(filename):
-    match = re.search(r'_frame_(\d+)\.(jpg|jpeg|png|webp)$', filename, re.IGNORECASE)
+    match = _FRAME_RE.search(filename)
     if match:
         return int(match.group(1))
     return 0
 
 def get_brightness_score(image_gray, mask):
-    masked_pixels = image_gray[mask > 0]
-    if masked_pixels.size == 0:
+    if cv2.countNonZero(mask) == 0:
         return 0.0
-    mean = np.mean(masked_pixels)
+    mean = cv2.mean(image_gray, mask=mask)[0]
     score = 1.0 - (abs(mean - IDEAL_BRIGHTNESS) / IDEAL_BRIGHTNESS)
     return max(0, score)
 
 def get_sharpness_score(image_gray, mask):
-    laplacian = cv2.Laplacian(image_gray, cv2.CV_64F)
-    masked_laplacian = laplacian[mask > 0]
-    if masked_laplacian.size == 0:
+    global _LAPLACIAN_SCRATCH, _CUDA_LAPLACIAN
+    if cv2.countNonZero(mask) == 0:
         return 0.0
-    return masked_laplacian.var()
+    if _LAPLACIAN_SCRATCH is None or _LAPLACIAN_SCRATCH.shape != image_gray.shape:
+        _LAPLACIAN_SCRATCH = np.empty(image_gray.shape, dtype=np.float32)
+    # float32 holds a uint8 Laplacian exactly; meanStdDev reads it in one
+    # masked pass without copying the masked pixels out first.
+    laplacian = None
+    if _CUDA_LAPLACIAN is not None:
+        gpu = _CUDA_LAPLACIAN
+        try:
+            gpu["gray"].upload(image_gray)
+            gpu["gray"].convertTo(cv2.CV_32F, gpu["gray_f32"])
+            gpu["filter"].apply(gpu["gray_f32"], gpu["laplacian"])
+            laplacian = gpu["laplacian"].download(_LAPLACIAN_SCRATCH)
+        except cv2.error:
+            # Stay on the CPU for the rest of this worker's images
+            _CUDA_LAPLACIAN = None
+    if laplacian is None:
+        laplacian = cv2.Laplacian(image_gray, cv2.CV_32F, dst=_LAPLACIAN_SCRATCH)
+    _, stddev = cv2.meanStdDev(laplacian, mask=mask)
+    return float(stddev[0, 0]) ** 2
 
 def get_pose_score(yolo_keypoints, category_name):
     if yolo_keypoints.shape[0] == 0: return 0.0
-    conf_tensor = yolo_keypoints.conf[0]
-    conf_map = {
-        KEYPOINT_NAMES[i]: conf_tensor[i].item() 
-        for i in range(len(KEYPOINT_NAMES))
-    }
-    get_conf = lambda name: conf_map.get(name, 0.0)
-
-    if category_name == "face_and_hair":
-        keypoints_to_check = FACE_KEYPOINTS
-    elif category_name == "upper_body":
-        keypoints_to_check = UPPER_BODY_KEYPOINTS
-    elif category_name == "full_body":
-        keypoints_to_check = FULL_BODY_KEYPOINTS
-    else:
-        return 0.0
+    indices = POSE_SCORE_INDICES.get(category_name)
+    if indices is None or indices.size == 0: return 0.0
+    # One device->host copy for all 17 confidences instead of 17 .item() syncs
+    confs = yolo_keypoints.conf[0].cpu().numpy()
+    return float(confs[indices].mean())
 
-    if not keypoints_to_check: return 0.0
-    total_confidence = sum(get_conf(name) for name in keypoints_to_check)
-    return total_confidence / len(keypoints_to_check)
+def get_phash(image_gray):
+    """
+    Perceptual hash of a grayscale image as a 16-char hex string, in the
+    same bit order as imagehash.phash. Compare with popcount64 of the XOR.
+    """
+    small = cv2.resize(image_gray, (PHASH_SIZE, PHASH_SIZE), interpolation=cv2.INTER_AREA)
+    dct = cv2.dct(small.astype(np.float32))[:PHASH_LOW_FREQ, :PHASH_LOW_FREQ] * PHASH_DCT_SCALE
+    bits = dct > np.median(dct)
+    return np.packbits(bits).tobytes().hex()
+
+def popcount64(values):
+    """Per-element set-bit count of a uint64 array."""
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(values)
+    return POPCOUNT_8[values.view(np.uint8)].reshape(-1, 8).sum(axis=1)
 
 def get_mask_score(mask):
     """
     Analyzes a mask for object count.
     Returns 1.0 (good) or 0.0 (bad).
     """
+    # Cheap gate: an all-transparent mask can't pass, so skip contour tracing
+    if cv2.countNonZero(mask) == 0:
+        return 0.0, "Fail: Empty mask"
+
     contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
     
     # --- Test 1: Contour Count (The "Ottoman" Test) ---
@@ -127,6 +266,119 @@ def get_mask_score(mask):
         
     return 1.0, f"Pass (C:{contour_count})"
 
+def load_image(img_path):
+    """
+    Decodes one masked PNG (BGRA) on a decode thread.
+    Returns (image, warning_message); image is None if it can't be scored.
+    """
+    try:
+        # The header alone says whether there is an alpha channel, so
+        # mask-less images are rejected without decoding any pixels.
+        with Image.open(img_path) as header:
+            has_alpha = header.mode in ("RGBA", "LA", "PA") or "transparency" in header.info
+        if not has_alpha:
+            return None, f"Warning: {img_path.name} is not 4-channel. Skipping."
+
+        image = cv2.imread(str(img_path), cv2.IMREAD_UNCHANGED)
+        if image is None: 
+            return None, f"Warning: Could not read {img_path.name}, skipping."
+
+        if image.shape[2] != 4:
+            return None, f"Warning: {img_path.name} is not 4-channel. Skipping."
+        return image, None
+    except Exception as e:
+        return None, f"Error on {img_path.name}: {e}"
+
+def score_image(img_path, image, cat_name):
+    """
+    Runs the Pass 1 filters and scorers on one decoded masked PNG in a worker process.
+    Returns (result_record, warning_message); either may be None.
+    """
+    try:
+        mask = cv2.extractChannel(image, 3) # The alpha channel is our mask
+
+        # Straight to gray: no full split and no intermediate BGR copy
+        image_gray = cv2.cvtColor(image, cv2.COLOR_BGRA2GRAY)
+
+        # --- Run Scorers & Filters ---
+
+        # --- FILTER 1: MASK QA ---
+        raw_mask_score, mask_status = get_mask_score(mask)
+        if raw_mask_score == 0.0:
+            return {
+                "file": str(img_path.name), "path": str(img_path), "phash": "N/A",
+                "source_video": get_source_video(img_path.name),
+                "frame_index": get_frame_index(img_path.name),
+                "scores": {
+                    "raw_brightness": 0, "raw_sharpness": 0, "raw_pose": 0,
+                    "raw_mask_score": 0.0, "mask_status": mask_status
+                },
+                "final_score": 0.0 # Discard
+            }, None
+
+        # --- FILTER 2: SHARPNESS QA ---
+        raw_sharpness = get_sharpness_score(image_gray, mask)
+        if raw_sharpness < MIN_SHARPNESS_THRESHOLD:
+            return {
+                "file": str(img_path.name), "path": str(img_path), "phash": "N/A",
+                "source_video": get_source_video(img_path.name),
+                "frame_index": get_frame_index(img_path.name),
+                "scores": {
+                    "raw_brightness": 0, "raw_sharpness": raw_sharpness, "raw_pose": 0,
+                    "raw_mask_score": 1.0, "mask_status": "Fail: Too blurry"
+                },
+                "final_score": 0.0 # Discard
+            }, None
+
+        # --- IMAGE PASSED ALL FILTERS ---
+
+        # 1. Pose
+        # Hand YOLO the already-decoded pixels (what it would get from
+        # imread on the path anyway) instead of decoding the PNG again.
+        # Sharpness above stays at full resolution: its threshold was tuned there.
+        h, w = image.shape[:2]
+        scale = INFERENCE_MAX_SIDE / max(h, w)
+        image_small = image
+        if scale < 1:
+            image_small = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        image_bgr = cv2.cvtColor(image_small, cv2.COLOR_BGRA2BGR)
+        results = _MODEL(image_bgr, device=DEVICE, verbose=False)
+        raw_pose = get_pose_score(results[0].keypoints, cat_name)
+
+        # 2. Brightness
+        raw_brightness = get_brightness_score(image_gray, mask)
+
+        # 3. pHash (works on grayscale, so reuse image_gray; no third decode)
+        phash = get_phash(image_gray)
+
+        return {
+            "file": str(img_path.name), "path": str(img_path),
+            "phash": phash, "source_video": get_source_video(img_path.name),
+            "frame_index": get_frame_index(img_path.name),
+            "scores": {
+                "raw_brightness": raw_brightness,
+                "raw_sharpness": raw_sharpness, # We already calculated this
+                "raw_pose": raw_pose,
+                "raw_mask_score": raw_mask_score,
+                "mask_status": mask_status
+            }
+        }, None
+    except Exception as e:
+        return None, f"Error on {img_path.name}: {e}"
+
+def score_chunk(img_paths, cat_name):
+    """
+    Scores a chunk of images in a worker process. The decode threads run
+    ahead, so PNG reads and decoding overlap scoring and inference.
+    """
+    out = []
+    for img_path, (image, warning) in zip(img_paths, _DECODER.map(load_image, img_paths)):
+        if image is None:
+            out.append((None, warning))
+        else:
+            out.append(score_image(img_path, image, cat_name))
+    return out
+
 def main():
     parser = argparse.ArgumentParser(description="Score and rank *masked* frames.")
     parser.add_argument(
@@ -162,39 +414,44 @@ def main():
         print(f"\n*** FATAL ERROR: Model file not found at {MODEL_PATH} ***")
         return
 
-    print(f"Loading model '{MODEL_PATH.name}'...")
-    model = YOLO(str(MODEL_PATH))
-    model.to(DEVICE)
-    print("Model loaded successfully.")
-
     print("\n--- Pass 0: Building Video Manifest ---")
     video_manifest = defaultdict(int)
     MASTER_FRAME_DIR = BASE_DIR.parent / "01_source_frames"
     if not MASTER_FRAME_DIR.is_dir():
         MASTER_FRAME_DIR = BASE_DIR / "01_source_frames" # Fallback
         
-    all_image_files = list(MASTER_FRAME_DIR.rglob("*.jpg")) + list(MASTER_FRAME_DIR.rglob("*.jpeg"))
+    all_image_files = find_files(MASTER_FRAME_DIR, SOURCE_FRAME_EXTENSIONS)
     
     if not all_image_files:
         print(f"*** FATAL ERROR: No images found in {MASTER_FRAME_DIR}. ***")
         return
 
     for img_path in tqdm(all_image_files, desc="Scanning all source files"):
-        source_video = get_source_video(img_path.name)
-        frame_index = get_frame_index(img_path.name)
+        name = img_path.name
+        source_video = get_source_video(name)
+        frame_index = get_frame_index(name)
         if frame_index > video_manifest[source_video]:
             video_manifest[source_video] = frame_index
     print(f"Manifest complete. Found max frame indices for {len(video_manifest)} videos.")
 
     all_final_results = {}
 
+    print(f"\nLoading model '{MODEL_PATH.name}' in {NUM_WORKERS} worker processes...")
+    # 'spawn' is required: CUDA is already initialized in this process and
+    # cannot be re-initialized in a forked child. The pool is created once
+    # and reused for every category.
+    executor = concurrent.futures.ProcessPoolExecutor(
+        max_workers=NUM_WORKERS, mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_worker, initargs=(MODEL_PATH,)
+    )
+
     for cat_name, cat_path in CATEGORIES_TO_SCORE.items():
         print(f"\n--- Processing Category: {cat_name} ---")
         if not cat_path.is_dir():
             print(f"Warning: Folder not found {cat_path}. Skipping.")
             continue
 
-        image_files = list(cat_path.glob("*.png"))
+        image_files = list_files(cat_path, MASKED_EXTENSIONS)
         
         if not image_files:
             print(f"No PNG images found in {cat_path}. Did 03_mask_subjects.py run?")
@@ -202,82 +459,15 @@ def main():
 
         all_category_scores = []
         
-        for img_path in tqdm(image_files, desc=f"Scoring {cat_name} (Pass 1)"):
-            try:
-                image = cv2.imread(str(img_path), cv2.IMREAD_UNCHANGED)
-                if image is None: 
-                    tqdm.write(f"Warning: Could not read {img_path.name}, skipping.")
-                    continue
-                
-                if image.shape[2] != 4:
-                    tqdm.write(f"Warning: {img_path.name} is not 4-channel. Skipping.")
-                    continue
-                    
-                b, g, r, a = cv2.split(image)
-                mask = a # The alpha channel is our mask
-                
-                image_bgr = cv2.cvtColor(image, cv2.COLOR_BGRA2BGR)
-                image_gray = cv2.cvtColor(image_bgr, cv2.COLOR_BGR2GRAY)
-
-                # --- Run Scorers & Filters ---
-                
-                # --- FILTER 1: MASK QA ---
-                raw_mask_score, mask_status = get_mask_score(mask)
-                if raw_mask_score == 0.0:
-                    all_category_scores.append({
-                        "file": str(img_path.name), "path": str(img_path), "phash": "N/A",
-                        "source_video": get_source_video(img_path.name),
-                        "frame_index": get_frame_index(img_path.name),
-                        "scores": {
-                            "raw_brightness": 0, "raw_sharpness": 0, "raw_pose": 0,
-                            "raw_mask_score": 0.0, "mask_status": mask_status
-                        },
-                        "final_score": 0.0 # Discard
-                    })
-                    continue # Skip to the next image
-                
-                # --- FILTER 2: SHARPNESS QA ---
-                raw_sharpness = get_sharpness_score(image_gray, mask)
-                if raw_sharpness < MIN_SHARPNESS_THRESHOLD:
-                    all_category_scores.append({
-                        "file": str(img_path.name), "path": str(img_path), "phash": "N/A",
-                        "source_video": get_source_video(img_path.name),
-                        "frame_index": get_frame_index(img_path.name),
-                        "scores": {
-                            "raw_brightness": 0, "raw_sharpness": raw_sharpness, "raw_pose": 0,
-                            "raw_mask_score": 1.0, "mask_status": "Fail: Too blurry"
-                        },
-                        "final_score": 0.0 # Discard
-                    })
-                    continue # Skip to the next image
-
-                # --- IMAGE PASSED ALL FILTERS ---
-                
-                # 1. Pose
-                results = model(str(img_path), device=DEVICE, verbose=False)
-                raw_pose = get_pose_score(results[0].keypoints, cat_name)
-                
-                # 2. Brightness
-                raw_brightness = get_brightness_score(image_gray, mask)
-                
-                # 3. pHash
-                image_pil = Image.open(img_path)
-                phash = str(imagehash.phash(image_pil))
-                
-                all_category_scores.append({
-                    "file": str(img_path.name), "path": str(img_path),
-                    "phash": phash, "source_video": get_source_video(img_path.name),
-                    "frame_index": get_frame_index(img_path.name),
-                    "scores": {
-                        "raw_brightness": raw_brightness,
-                        "raw_sharpness": raw_sharpness, # We already calculated this
-                        "raw_pose": raw_pose,
-                        "raw_mask_score": raw_mask_score,
-                        "mask_status": mask_status
-                    }
-                })
-            except Exception as e:
-                tqdm.write(f"Error on {img_path.name}: {e}")
+        chunks = [image_files[i:i + CHUNK_SIZE] for i in range(0, len(image_files), CHUNK_SIZE)]
+        results = itertools.chain.from_iterable(
+            executor.map(score_chunk, chunks, itertools.repeat(cat_name))
+        )
+        for record, warning in tqdm(results, total=len(image_files), desc=f"Scoring {cat_name} (Pass 1)"):
+            if warning is not None:
+                tqdm.write(warning)
+            if record is not None:
+                all_category_scores.append(record)
 
         if not all_category_scores:
             print("No valid images scored in this category. Skipping.")
@@ -311,42 +501,49 @@ def main():
 
         print(f"Building unique top {TOP_N_IMAGES} list (3-Stage Filter)...")
         top_n_items = []
-        seen_global_hashes = set()
-        seen_source_hashes = defaultdict(list)
-        seen_source_frame_indices = defaultdict(list)
+        # Accepted hashes packed into uint64 arrays, so each duplicate check
+        # is a single vectorized XOR + popcount instead of a Python loop.
+        seen_global_hashes = np.empty(TOP_N_IMAGES, dtype=np.uint64)
+        seen_global_count = 0
+        seen_source_hashes = defaultdict(lambda: np.empty(0, dtype=np.uint64))
+        # Temporal quota state per source: how many frames were accepted and
+        # the sum of their indices (all the check needs is the average).
+        seen_source_count = defaultdict(int)
+        seen_source_index_sum = defaultdict(int)
 
         is_face_category = (cat_name == "face_and_hair")
 
-        for item in tqdm(all_category_scores, desc=f"Filtering unique {cat_name}"):
+        # Parse every hash once up front ("N/A" for QA rejects -> 0, never read)
+        all_hashes = np.fromiter(
+            (int(item["phash"], 16) if item["phash"] != "N/A" else 0 for item in all_category_scores),
+            dtype=np.uint64, count=len(all_category_scores)
+        )
+
+        for item, current_hash in tqdm(zip(all_category_scores, all_hashes), total=len(all_category_scores), desc=f"Filtering unique {cat_name}"):
             if len(top_n_items) >= TOP_N_IMAGES: break
             
             if item['final_score'] == 0.0:
                 continue
                 
-            current_hash = imagehash.hex_to_hash(item["phash"])
             current_source_video = item["source_video"]
 
-            is_global_dupe = False
-            for seen_hash in seen_global_hashes:
-                if (current_hash - seen_hash) < GLOBAL_HASH_THRESHOLD:
-                    is_global_dupe = True; break
-            if is_global_dupe: continue
+            if seen_global_count:
+                distances = popcount64(seen_global_hashes[:seen_global_count] ^ current_hash)
+                if (distances < GLOBAL_HASH_THRESHOLD).any(): continue
 
-            is_source_dupe = False
-            for seen_hash in seen_source_hashes[current_source_video]:
-                if (current_hash - seen_hash) < INTRA_SOURCE_HASH_THRESHOLD:
-                    is_source_dupe = True; break
-            if is_source_dupe: continue
+            source_hashes = seen_source_hashes[current_source_video]
+            if source_hashes.size:
+                distances = popcount64(source_hashes ^ current_hash)
+                if (distances < INTRA_SOURCE_HASH_THRESHOLD).any(): continue
 
             if not is_face_category:
-                selected_indices = seen_source_frame_indices[current_source_video]
-                selected_count = len(selected_indices)
+                selected_count = seen_source_count[current_source_video]
                 total_frames = video_manifest.get(current_source_video, 0) 
 
                 if total_frames == 0: continue
 
                 if selected_count == 5:
-                    avg_index = sum(selected_indices) / 5
+                    avg_index = seen_source_index_sum[current_source_video] / 5
                     midpoint = total_frames / 2
                     current_index = item["frame_index"]
                     test_passed = False
@@ -360,10 +557,12 @@ def main():
                     continue
 
             top_n_items.append(item)
-            seen_global_hashes.add(current_hash)
-            seen_source_hashes[current_source_video].append(current_hash)
+            seen_global_hashes[seen_global_count] = current_hash
+            seen_global_count += 1
+            seen_source_hashes[current_source_video] = np.append(source_hashes, current_hash)
             if not is_face_category:
-                seen_source_frame_indices[current_source_video].append(item["frame_index"])
+                seen_source_count[current_source_video] += 1
+                seen_source_index_sum[current_source_video] += item["frame_index"]
         
         all_final_results[cat_name] = all_category_scores 
         
@@ -378,16 +577,19 @@ def main():
             original_path = Path(item["path"])
             new_filename = f"{rank:03d}_{original_path.name}"
             dest_path = dest_folder / new_filename
-            copy2(original_path, dest_path)
+            place_file(original_path, dest_path)
             
             txt_path = original_path.with_suffix(".txt")
             if txt_path.exists():
                 copy2(txt_path, dest_path.with_suffix(".txt"))
 
+    executor.shutdown()
+
     print(f"\nSaving detailed scoring report to {OUTPUT_JSON_FILE}...")
     try:
-        with open(OUTPUT_JSON_FILE, 'w') as f:
-            json.dump(all_final_results, f, indent=2)
+        # Indented so the audit report stays readable; at top-N size the
+        # slower encoder costs next to nothing.
+        OUTPUT_JSON_FILE.write_text(json.dumps(all_final_results, indent=2))
     except Exception as e:
         print(f"Error saving JSON report: {e}")
 
@@ -1,14 +1,18 @@
 #!/usr/bin/env python3
 
-import sys, os, time
+import sys, re, json
 from pathlib import Path
 from tqdm import tqdm
 import vertexai
+import google.auth
+import google.auth.transport.requests
 from vertexai.generative_models import (
     GenerativeModel, Part, GenerationConfig, HarmCategory, SafetySetting
 )
 import argparse
 import logging
+import concurrent.futures
+from common import list_files, RateLimiter, generate_with_retry
 
 # --- Configuration ---
 LOCATION = "us-central1"
@@ -22,6 +26,8 @@ Focus on their clothing, pose, action, and expression.
 DO NOT describe the background. Ignore it completely.
 Do not mention tattoos, watermarks, or text.
 Be concise and factual. Do not use the subject's name.
+Keep the caption gender-neutral: never use words like woman, man, girl, boy or person.
+Start directly with the description, never with 'a photo of' or 'an image of'.
 Example: 'long brown hair, wearing a pink cardigan, looking over their shoulder'"""
 
 SAFETY_SETTINGS = {
@@ -30,8 +36,126 @@ SAFETY_SETTINGS = {
     HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: SafetySetting.HarmBlockThreshold.BLOCK_NONE,
     HarmCategory.HARM_CATEGORY_HARASSMENT: SafetySetting.HarmBlockThreshold.BLOCK_NONE,
 }
+# Requests in flight at once, and the overall request rate they share
+CAPTION_WORKERS = 8
+MAX_REQUESTS_PER_MINUTE = 60
+
+# Images sent together in one request when --images_per_request > 1.
+# A batch is also closed early once its images add up to this many bytes,
+# to stay well under the request size limit.
+MAX_BATCH_BYTES = 12 * 1024 * 1024
+
+# Appended after the images of a multi-image request
+BATCH_PROMPT = """Caption each of the {n} images above separately, following the same rules.
+Return only a JSON array of {n} strings, one caption per image, in the same order."""
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp"}
+CAPTION_EXTENSIONS = {".txt"}
 # --- End Configuration ---
 
+# Leading "a photo of a woman " / "image of " / "a person " etc., stripped
+# once from the start of each caption to keep captions gender-neutral.
+# The prompt asks for this too; this catches the model ignoring it.
+_LEAD_RE = re.compile(r'^(?:(?:a )?(?:photo|image) of )?(?:an? (?:woman|man|person) )?')
+
+# Structured output: the model returns {"caption": "..."} for one image,
+# or a JSON array of captions for a multi-image request.
+CAPTION_CONFIG = GenerationConfig(
+    temperature=0.2, response_mime_type="application/json",
+    response_schema={
+        "type": "object",
+        "properties": {"caption": {"type": "string"}},
+        "required": ["caption"],
+    },
+)
+BATCH_CONFIG = GenerationConfig(
+    temperature=0.2, response_mime_type="application/json",
+    response_schema={"type": "array", "items": {"type": "string"}},
+)
+
+def load_image_part(img_path):
+    """Reads an image file into a Part for the request."""
+    with open(img_path, "rb") as f: image_bytes = f.read()
+    mime_type = "image/jpeg" if img_path.suffix.lower() == ".jpg" else f"image/{img_path.suffix.lstrip('.')}"
+    return Part.from_data(image_bytes, mime_type=mime_type)
+
+def clean_caption(caption, trigger_words):
+    """Applies the gender-neutral and tattoo/watermark filters and prefixes the trigger words."""
+    caption = caption.strip().lower()
+
+    # Gender-neutral replacements
+    caption = _LEAD_RE.sub("", caption, count=1)
+
+    # --- Hard-filter for tattoo/watermark ---
+    caption = caption.replace("tattoo", "").replace("tattoos", "")
+    caption = caption.replace(", ,", ",").replace("  ", " ").replace(" ,", ",").strip()
+
+    return trigger_words + caption
+
+def caption_image(model, img_path, trigger_words, limiter):
+    """
+    Captions one image and writes its .txt file (runs on a worker thread).
+    Returns an error message, or None on success.
+    """
+    try:
+        response = generate_with_retry(model, [load_image_part(img_path)], limiter, CAPTION_CONFIG, SAFETY_SETTINGS)
+        caption = json.loads(response.text)["caption"]
+        img_path.with_suffix(".txt").write_text(clean_caption(caption, trigger_words))
+        return None
+    except Exception as e:
+        return f"Error processing {img_path}: {e}"
+
+def caption_batch(model, img_paths, trigger_words, limiter):
+    """
+    Captions several images with one request and writes their .txt files
+    (runs on a worker thread). If the reply isn't one caption per image,
+    the batch is retried one image per request. Returns a list of error messages.
+    """
+    if len(img_paths) == 1:
+        error = caption_image(model, img_paths[0], trigger_words, limiter)
+        return [error] if error is not None else []
+
+    try:
+        parts = []
+        for i, img_path in enumerate(img_paths, start=1):
+            parts.append(Part.from_text(f"Image {i}:"))
+            parts.append(load_image_part(img_path))
+        parts.append(Part.from_text(BATCH_PROMPT.format(n=len(img_paths))))
+
+        response = generate_with_retry(model, parts, limiter, BATCH_CONFIG, SAFETY_SETTINGS)
+        captions = json.loads(response.text)
+        if not (isinstance(captions, list) and len(captions) == len(img_paths)
+                and all(isinstance(c, str) for c in captions)):
+            raise ValueError(f"expected a JSON array of {len(img_paths)} captions")
+    except Exception as e:
+        tqdm.write(f"  Batch of {len(img_paths)} failed ({e}), captioning one by one...")
+        errors = [caption_image(model, p, trigger_words, limiter) for p in img_paths]
+        return [error for error in errors if error is not None]
+
+    errors = []
+    for img_path, caption in zip(img_paths, captions):
+        try:
+            img_path.with_suffix(".txt").write_text(clean_caption(caption, trigger_words))
+        except Exception as e:
+            errors.append(f"Error processing {img_path}: {e}")
+    return errors
+
+def make_batches(img_paths, images_per_request):
+    """Groups img_paths into batches of up to images_per_request images and MAX_BATCH_BYTES bytes."""
+    if images_per_request <= 1:
+        return [[p] for p in img_paths]
+    batches, batch, batch_bytes = [], [], 0
+    for img_path in img_paths:
+        size = img_path.stat().st_size
+        if batch and (len(batch) == images_per_request or batch_bytes + size > MAX_BATCH_BYTES):
+            batches.append(batch)
+            batch, batch_bytes = [], 0
+        batch.append(img_path)
+        batch_bytes += size
+    if batch:
+        batches.append(batch)
+    return batches
+
 def main():
     parser = argparse.ArgumentParser(description="Caption images using Vertex AI.")
     parser.add_argument(
@@ -52,6 +176,12 @@ def main():
         default="ohwx tara, ", 
         help="Trigger words to prefix to every caption"
     )
+    parser.add_argument(
+        "--images_per_request",
+        type=int,
+        default=1,
+        help="Caption this many images per API request (e.g. 4). 1 sends each image on its own."
+    )
     args = parser.parse_args()
     
     INPUT_DIR = Path(args.base_dir) / "05_training_data"
@@ -64,8 +194,15 @@ def main():
         return
 
     try:
-        vertexai.init(project=args.project_id, location=LOCATION)
+        # Resolve and refresh the credentials once up front, so the worker
+        # threads share one token instead of the first requests racing to
+        # fetch it.
+        credentials, _ = google.auth.default(scopes=["https://www.googleapis.com/auth/cloud-platform"])
+        credentials.refresh(google.auth.transport.requests.Request())
+        vertexai.init(project=args.project_id, location=LOCATION, credentials=credentials)
         model = GenerativeModel(MODEL_ID, system_instruction=[API_PROMPT])
+        # One cheap call opens the client's channel before the real work starts
+        model.count_tokens("ping")
         print(f"Successfully loaded Vertex AI model: {MODEL_ID} for project {args.project_id}")
     except Exception as e:
         print(f"Error initializing Vertex AI: {e}")
@@ -76,53 +213,35 @@ def main():
         print(f"Error: No category folders found in {INPUT_DIR}. Exiting.")
         return
 
+    limiter = RateLimiter(MAX_REQUESTS_PER_MINUTE)
+
     for folder_path in source_folders:
         print(f"\nProcessing category: {folder_path.name}")
         
-        image_files = list(folder_path.glob("*.jpg")) + list(folder_path.glob("*.jpeg")) + \
-                      list(folder_path.glob("*.png")) + list(folder_path.glob("*.webp"))
+        image_files = list_files(folder_path, IMAGE_EXTENSIONS)
         
         if not image_files:
             print(f"No images found in {folder_path}. Skipping.")
             continue
-            
-        print(f"Found {len(image_files)} images. Starting caption generation...")
-
-        for img_path in tqdm(image_files, desc=f"Generating captions in {folder_path.name}"):
-            txt_path = img_path.with_suffix(".txt")
-            if txt_path.exists():
-                tqdm.write(f"Skipping {img_path.name}, caption already exists.")
-                continue
-            try:
-                with open(img_path, "rb") as f: image_bytes = f.read()
-                mime_type = "image/jpeg" if img_path.suffix.lower() == ".jpg" else f"image/{img_path.suffix.lstrip('.')}"
-                image_part = Part.from_data(image_bytes, mime_type=mime_type)
-
-                response = model.generate_content(
-                    [image_part],
-                    safety_settings=SAFETY_SETTINGS,
-                    generation_config=GenerationConfig(temperature=0.2)
-                )
-                caption = response.text.strip().lower()
-                
-                # Gender-neutral replacements
-                caption = caption.replace("a woman ", "", 1).replace("a photo of a woman ", "", 1)
-                caption = caption.replace("a man ", "", 1).replace("a photo of a man ", "", 1)
-                caption = caption.replace("a person ", "", 1).replace("a photo of a person ", "", 1)
-                caption = caption.replace("photo of ", "", 1).replace("image of ", "", 1)
-
-                # --- Hard-filter for tattoo/watermark ---
-                caption = caption.replace("tattoo", "").replace("tattoos", "")
-                caption = caption.replace(", ,", ",").replace("  ", " ").replace(" ,", ",").strip()
-
-                final_caption = args.trigger_words + caption
-                txt_path.write_text(final_caption)
-                
-                time.sleep(1.1) 
-            except Exception as e:
-                print(f"\nError processing {img_path}: {e}")
-                if "quota" in str(e).lower():
-                    print("Quota error. Pausing for 60 seconds..."); time.sleep(60)
+
+        # Drop already-captioned images before any work is queued
+        # (one directory listing instead of a stat per image)
+        captioned = {p.stem for p in list_files(folder_path, CAPTION_EXTENSIONS)}
+        to_caption = [p for p in image_files if p.stem not in captioned]
+        print(f"Found {len(image_files)} images ({len(image_files) - len(to_caption)} already captioned). Starting caption generation...")
+
+        # Several requests in flight at once, paced by the shared limiter
+        # instead of a fixed sleep after each serial request.
+        with concurrent.futures.ThreadPoolExecutor(max_workers=CAPTION_WORKERS) as executor:
+            futures = {
+                executor.submit(caption_batch, model, batch, args.trigger_words, limiter): len(batch)
+                for batch in make_batches(to_caption, args.images_per_request)
+            }
+            with tqdm(total=len(to_caption), desc=f"Generating captions in {folder_path.name}") as pbar:
+                for future in concurrent.futures.as_completed(futures):
+                    for error in future.result():
+                        tqdm.write(error)
+                    pbar.update(futures[future])
                     
     print("\n--- Process Complete ---")
     print(f"Captioning finished for: {INPUT_DIR}")
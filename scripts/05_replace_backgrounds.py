@@ -1,6 +1,5 @@
 #!/usr/bin/env python3
 
-import os
 from pathlib import Path
 from shutil import rmtree, copy2
 from tqdm import tqdm
@@ -8,6 +7,9 @@ from PIL import Image, ImageOps, ImageFilter
 import random
 import logging
 import argparse
+import queue
+import threading
+from common import list_files
 
 # --- Configuration ---
 IMAGE_QUALITY = 95
@@ -17,6 +19,12 @@ IMAGE_QUALITY = 95
 # 2.0 is a light blur, 5.0 is a stronger blur.
 # Let's start with 3.0
 BLUR_RADIUS = 3.0
+
+# Max finished images waiting to be JPEG-encoded by the writer thread
+WRITE_QUEUE_SIZE = 16
+
+BACKGROUND_EXTENSIONS = {".jpg", ".jpeg", ".png"}
+MASKED_EXTENSIONS = {".png"}
 # --- End Configuration ---
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -62,6 +70,24 @@ def prepare_background(bg_path, target_w, target_h):
         black_bg = Image.new("RGB", (target_w, target_h), (0, 0, 0))
         return black_bg.filter(ImageFilter.GaussianBlur(radius=BLUR_RADIUS))
 
+def write_outputs(write_queue):
+    """
+    Writer thread: JPEG-encodes and saves composited images (plus their
+    caption files) so the main loop can move on to the next composite.
+    Stops when it receives None.
+    """
+    while True:
+        job = write_queue.get()
+        if job is None:
+            break
+        image, output_filename, txt_path, txt_output = job
+        try:
+            image.save(output_filename, "JPEG", quality=IMAGE_QUALITY)
+            if txt_path.exists():
+                copy2(txt_path, txt_output)
+        except Exception as e:
+            tqdm.write(f"Error writing {output_filename.name}: {e}")
+
 def main():
     parser = argparse.ArgumentParser(description="Replace backgrounds from a library with blur.")
     parser.add_argument(
@@ -91,9 +117,7 @@ def main():
         return
 
     logging.info(f"Scanning for backgrounds in: {BACKGROUND_LIB_DIR}")
-    background_files = list(BACKGROUND_LIB_DIR.glob("*.jpg")) + \
-                       list(BACKGROUND_LIB_DIR.glob("*.jpeg")) + \
-                       list(BACKGROUND_LIB_DIR.glob("*.png"))
+    background_files = list_files(BACKGROUND_LIB_DIR, BACKGROUND_EXTENSIONS)
                        
     if not background_files:
         logging.error(f"*** FATAL ERROR: No .jpg or .png backgrounds found in library. ***")
@@ -107,6 +131,10 @@ def main():
         logging.warning(f"No category folders found in {SOURCE_DIR}. Nothing to do.")
         return
 
+    write_queue = queue.Queue(maxsize=WRITE_QUEUE_SIZE)
+    writer = threading.Thread(target=write_outputs, args=(write_queue,), daemon=True)
+    writer.start()
+
     for source_folder in source_folders:
         output_folder = OUTPUT_DIR / source_folder.name
         
@@ -117,7 +145,7 @@ def main():
             rmtree(output_folder)
         output_folder.mkdir(parents=True, exist_ok=True)
 
-        image_files = list(source_folder.glob("*.png"))
+        image_files = list_files(source_folder, MASKED_EXTENSIONS)
 
         if not image_files:
             logging.warning("No .png images found in this folder. Skipping.")
@@ -136,19 +164,24 @@ def main():
                     # 3. Composite the image
                     # Paste the SHARP foreground onto the BLURRED background
                     blurred_background_crop.paste(foreground, (0, 0), foreground)
-                    
-                    # 4. Save as a high-quality JPEG
-                    output_filename = output_folder / f"{img_path.stem}.jpg"
-                    blurred_background_crop.save(output_filename, "JPEG", quality=IMAGE_QUALITY)
 
-                # 5. Copy the caption file, if one exists
+                # 4. Save as a high-quality JPEG and 5. copy the caption
+                # file, if one exists (both on the writer thread)
                 txt_path = img_path.with_suffix(".txt")
-                if txt_path.exists():
-                    copy2(txt_path, output_folder / txt_path.name)
+                write_queue.put((
+                    blurred_background_crop,
+                    output_folder / f"{img_path.stem}.jpg",
+                    txt_path,
+                    output_folder / txt_path.name
+                ))
 
             except Exception as e:
                 tqdm.write(f"Error processing {img_path.name}: {e}")
 
+    # Flush the remaining writes before reporting completion
+    write_queue.put(None)
+    writer.join()
+
     logging.info("\n--- Step 5 Complete ---")
     logging.info(f"Your final (blurred bg) training images are in: {OUTPUT_DIR}")
     logging.info("These folders are now ready for captioning.")
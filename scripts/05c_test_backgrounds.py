@@ -1,6 +1,6 @@
 #!/usr/bin/env python3
 
-import sys, os, time
+import sys
 from pathlib import Path
 from tqdm import tqdm
 import vertexai
@@ -9,6 +9,8 @@ from vertexai.generative_models import (
 )
 import argparse
 import logging
+import concurrent.futures
+from common import list_files, RateLimiter, generate_with_retry
 
 # --- Configuration ---
 LOCATION = "us-central1"
@@ -27,8 +29,38 @@ SAFETY_SETTINGS = {
     HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: SafetySetting.HarmBlockThreshold.BLOCK_NONE,
     HarmCategory.HARM_CATEGORY_HARASSMENT: SafetySetting.HarmBlockThreshold.BLOCK_NONE,
 }
+# Requests in flight at once, and the overall request rate they share
+CAPTION_WORKERS = 8
+MAX_REQUESTS_PER_MINUTE = 60
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp"}
+CAPTION_EXTENSIONS = {".txt"}
 # --- End Configuration ---
 
+def caption_background(model, img_path, limiter):
+    """
+    Captions one background and writes its .txt file (runs on a worker thread).
+    Returns an error message, or None on success.
+    """
+    txt_path = img_path.with_suffix(".txt")
+    try:
+        with open(img_path, "rb") as f: image_bytes = f.read()
+        mime_type = "image/jpeg" if img_path.suffix.lower() == ".jpg" else f"image/{img_path.suffix.lstrip('.')}"
+        image_part = Part.from_data(image_bytes, mime_type=mime_type)
+
+        # Quota (429) and other transient errors are retried with backoff
+        response = generate_with_retry(
+            model, [image_part], limiter,
+            GenerationConfig(temperature=0.2), SAFETY_SETTINGS
+        )
+        caption = response.text.strip().lower()
+
+        # --- FIXED: No trigger words or replacements needed ---
+        txt_path.write_text(caption)
+        return None
+    except Exception as e:
+        return f"Error processing {img_path}: {e}"
+
 def main():
     # --- FIXED: Corrected argument parser ---
     parser = argparse.ArgumentParser(description="Unit test backgrounds for caption noise.")
@@ -59,41 +91,31 @@ def main():
         return
 
     # --- FIXED: No sub-folders, just image files ---
-    image_files = list(INPUT_DIR.glob("*.jpg")) + list(INPUT_DIR.glob("*.jpeg")) + \
-                  list(INPUT_DIR.glob("*.png")) + list(INPUT_DIR.glob("*.webp"))
+    image_files = list_files(INPUT_DIR, IMAGE_EXTENSIONS)
     
     if not image_files:
         print(f"Error: No images found in {INPUT_DIR}. Exiting.")
         return
         
-    print(f"Found {len(image_files)} backgrounds. Starting caption generation...")
+    # Drop already-captioned backgrounds before any work is queued
+    # (one directory listing instead of a stat per image)
+    captioned = {p.stem for p in list_files(INPUT_DIR, CAPTION_EXTENSIONS)}
+    to_caption = [p for p in image_files if p.stem not in captioned]
+    print(f"Found {len(image_files)} backgrounds ({len(image_files) - len(to_caption)} already captioned). Starting caption generation...")
 
-    for img_path in tqdm(image_files, desc="Testing backgrounds"):
-        txt_path = img_path.with_suffix(".txt")
-        if txt_path.exists():
-            tqdm.write(f"Skipping {img_path.name}, caption already exists.")
-            continue
-        try:
-            with open(img_path, "rb") as f: image_bytes = f.read()
-            mime_type = "image/jpeg" if img_path.suffix.lower() == ".jpg" else f"image/{img_path.suffix.lstrip('.')}"
-            image_part = Part.from_data(image_bytes, mime_type=mime_type)
+    # Several requests in flight at once, paced by a shared limiter
+    # instead of a fixed sleep after each serial request.
+    limiter = RateLimiter(MAX_REQUESTS_PER_MINUTE)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=CAPTION_WORKERS) as executor:
+        futures = [
+            executor.submit(caption_background, model, img_path, limiter)
+            for img_path in to_caption
+        ]
+        for future in tqdm(concurrent.futures.as_completed(futures), total=len(futures), desc="Testing backgrounds"):
+            error = future.result()
+            if error is not None:
+                tqdm.write(error)
 
-            response = model.generate_content(
-                [image_part],
-                safety_settings=SAFETY_SETTINGS,
-                generation_config=GenerationConfig(temperature=0.2)
-            )
-            caption = response.text.strip().lower()
-            
-            # --- FIXED: No trigger words or replacements needed ---
-            txt_path.write_text(caption)
-            
-            time.sleep(1.1) 
-        except Exception as e:
-            print(f"\nError processing {img_path}: {e}")
-            if "quota" in str(e).lower():
-                print("Quota error. Pausing for 60 seconds..."); time.sleep(60)
-                
     print("\n--- Background Test Complete ---")
     print(f"All backgrounds in {INPUT_DIR} have been captioned.")
 
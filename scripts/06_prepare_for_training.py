@@ -1,10 +1,12 @@
 #!/usr/bin/env python3
 
 import os
+import fcntl
 import shutil
 from pathlib import Path
 from tqdm import tqdm
 import logging
+from common import list_files
 
 # --- Configuration ---
 # This is the output from your 04_ and 05_ scripts
@@ -20,10 +22,35 @@ CATEGORY_MAP = {
     "upper_body": "10_tara_tainton_upper",
     "full_body": "5_tara_tainton_full"
 }
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png"}
 # --- End Configuration ---
 
+# ioctl request number for a reflink clone (linux/fs.h)
+FICLONE = 0x40049409
+
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+def place_file(src, dst):
+    """
+    Puts src at dst without duplicating its bytes where possible:
+    hardlink first, then a reflink clone (Btrfs/XFS), then a real copy.
+    Only used for images: the trainer only reads them, so sharing the
+    inode is safe. Captions are hand-edited, so they are always copied.
+    """
+    try:
+        os.link(src, dst)
+        return
+    except OSError:
+        pass
+    try:
+        with open(src, 'rb') as f_in, open(dst, 'wb') as f_out:
+            fcntl.ioctl(f_out.fileno(), FICLONE, f_in.fileno())
+        return
+    except OSError:
+        pass
+    shutil.copy(src, dst)
+
 def main():
     logging.info(f"Starting Kohya preparation...")
 
@@ -48,9 +75,7 @@ def main():
         logging.info(f"Processing '{source_folder.name}' -> '{kohya_name}'")
 
         # Find all images and their matching .txt files
-        image_files = list(source_folder.glob("*.jpg")) + \
-                      list(source_folder.glob("*.jpeg")) + \
-                      list(source_folder.glob("*.png"))
+        image_files = list_files(source_folder, IMAGE_EXTENSIONS)
 
         if not image_files:
             logging.warning(f"No images found in {source_folder}. Skipping.")
@@ -64,9 +89,9 @@ def main():
                 logging.warning(f"  Missing caption for {img_path.name}! Skipping file.")
                 continue
 
-            # Copy both files
-            shutil.copy(img_path, kohya_output_path / img_path.name)
-            shutil.copy(txt_path, kohya_output_path / txt_path.name)
+            # Link (or copy) both files
+            place_file(img_path, kohya_output_path / img_path.name)
+            shutil.copy2(txt_path, kohya_output_path / txt_path.name)
             file_count += 1
 
         logging.info(f"Copied {file_count} image/caption pairs for {kohya_name}.")
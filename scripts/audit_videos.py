@@ -1,17 +1,19 @@
 #!/usr/bin/env python3
 
-import os
 import subprocess
 import json
 from pathlib import Path
 from tqdm import tqdm
 import logging
+from common import find_files
 
 # --- Configuration ---
 VIDEO_SOURCE_DIR = Path("/projects/source_videos_high_res")
 TARGET_WIDTH = 1920
 TARGET_HEIGHT = 1080
 FRAMES_PER_SECOND = 1.0 # From your 01_extract.py
+
+VIDEO_EXTENSIONS = {".mp4", ".mov", ".m4v", ".avi", ".mkv", ".webm"}
 # --- End Configuration ---
 
 logging.basicConfig(level=logging.INFO, format='%(message)s')
@@ -59,12 +61,7 @@ def main():
         logging.error(f"FATAL: Source directory not found: {VIDEO_SOURCE_DIR}")
         return
 
-    video_files = list(VIDEO_SOURCE_DIR.rglob("*.mp4")) + \
-                  list(VIDEO_SOURCE_DIR.rglob("*.mov")) + \
-                  list(VIDEO_SOURCE_DIR.rglob("*.m4v")) + \
-                  list(VIDEO_SOURCE_DIR.rglob("*.avi")) + \
-                  list(VIDEO_SOURCE_DIR.rglob("*.mkv")) + \
-                  list(VIDEO_SOURCE_DIR.rglob("*.webm"))
+    video_files = find_files(VIDEO_SOURCE_DIR, VIDEO_EXTENSIONS)
 
     if not video_files:
         logging.error(f"No video files found in {VIDEO_SOURCE_DIR}.")
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+"""
+Helpers shared by the pipeline scripts. Every script runs from scripts/,
+so they import this as a plain module: `from common import list_files`.
+"""
+
+import os
+import json
+import time
+import random
+import logging
+import threading
+import itertools
+import subprocess
+import collections
+import concurrent.futures
+from pathlib import Path
+from PIL import Image
+from tqdm import tqdm
+
+try:
+    from google.api_core import exceptions as api_exceptions
+except ImportError:
+    # Only the Gemini captioning scripts need it
+    api_exceptions = None
+
+# --- Configuration ---
+# ffprobe durations cached in the frame output folder by video path,
+# validated against (mtime_ns, size). Shared by 01_extract and 01b.
+PROBE_CACHE_NAME = ".ffprobe_cache.json"
+
+# Transient Gemini API errors are retried with exponential backoff and
+# jitter: attempt n waits a random time between RETRY_MIN_WAIT and
+# min(RETRY_MAX_WAIT, RETRY_MIN_WAIT * 2**n) seconds.
+RETRY_ATTEMPTS = 8
+RETRY_MIN_WAIT = 1.0
+RETRY_MAX_WAIT = 64.0
+# --- End Configuration ---
+
+# Errors worth retrying. Anything else (InvalidArgument, PermissionDenied,
+# ...) fails the image on the first attempt.
+RETRYABLE_ERRORS = (
+    api_exceptions.ResourceExhausted,
+    api_exceptions.ServiceUnavailable,
+    api_exceptions.InternalServerError,
+    api_exceptions.DeadlineExceeded,
+) if api_exceptions is not None else ()
+
+def list_files(folder, extensions):
+    """Lists the files directly in folder whose suffix is in extensions (case-insensitive)."""
+    with os.scandir(folder) as it:
+        return [
+            Path(entry.path) for entry in it
+            if entry.is_file() and os.path.splitext(entry.name)[1].lower() in extensions
+        ]
+
+def find_files(root, extensions):
+    """Walks root once and returns every file whose suffix is in extensions (case-insensitive)."""
+    return [
+        Path(dirpath) / name
+        for dirpath, _, filenames in os.walk(root)
+        for name in filenames
+        if os.path.splitext(name)[1].lower() in extensions
+    ]
+
+def load_json_cache(cache_path):
+    """Returns a JSON cache written by a previous run, or {} if there is none."""
+    try:
+        with open(cache_path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def get_video_duration(video_path):
+    """Uses ffprobe to get the duration of a video, or 0.0 if it can't be probed."""
+    command = [
+        "ffprobe", "-v", "quiet", "-print_format", "json",
+        "-show_streams", str(video_path)
+    ]
+    try:
+        result = subprocess.run(command, capture_output=True, text=True, check=True)
+        data = json.loads(result.stdout)
+        for stream in data.get("streams", []):
+            if stream.get("codec_type") == "video":
+                return float(stream.get("duration", 0.0))
+    except Exception as e:
+        logging.warning(f"  WARN: Could not probe file {video_path.name}. Error: {e}")
+        return 0.0
+    return 0.0
+
+def probe_videos(video_files, cache_path, workers):
+    """
+    Returns {video_path: duration} for every video. Only videos that are
+    new or changed (by mtime and size) since the cache was written are
+    probed, workers at a time.
+    """
+    cache = load_json_cache(cache_path)
+    durations, stats, to_probe = {}, {}, []
+    for video_path in video_files:
+        st = video_path.stat()
+        stats[video_path] = [st.st_mtime_ns, st.st_size]
+        entry = cache.get(str(video_path))
+        if entry is not None and entry["stat"] == stats[video_path]:
+            durations[video_path] = entry["duration"]
+        else:
+            to_probe.append(video_path)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as probe_executor:
+        durations.update(zip(to_probe, probe_executor.map(get_video_duration, to_probe)))
+
+    # Failed probes are not cached, so they are retried next run
+    for video_path in to_probe:
+        duration = durations[video_path]
+        if duration > 0:
+            cache[str(video_path)] = {"stat": stats[video_path], "duration": duration}
+    try:
+        cache_path.write_text(json.dumps(cache))
+    except OSError as e:
+        logging.warning(f"Could not write ffprobe cache {cache_path}: {e}")
+    return durations
+
+def prefetch(executor, fn, items, window):
+    """
+    Like executor.map(fn, items), but keeps at most window calls submitted
+    ahead of the consumer so only a few decoded images sit in memory.
+    """
+    items = iter(items)
+    pending = collections.deque(executor.submit(fn, item) for item in itertools.islice(items, window))
+    while pending:
+        result = pending.popleft().result()
+        for item in itertools.islice(items, 1):
+            pending.append(executor.submit(fn, item))
+        yield result
+
+def load_input(img_path):
+    """Decodes one input image on a reader thread. Returns (PIL image, error_message)."""
+    try:
+        with Image.open(img_path) as img:
+            img.load()
+        return img, None
+    except Exception as e:
+        return None, str(e)
+
+class RateLimiter:
+    """Spaces calls to wait() evenly so all threads together stay under max_per_minute."""
+    def __init__(self, max_per_minute):
+        self.interval = 60.0 / max_per_minute
+        self.lock = threading.Lock()
+        self.next_slot = time.monotonic()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_slot - now
+            self.next_slot = max(now, self.next_slot) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+def generate_with_retry(model, parts, limiter, generation_config, safety_settings):
+    """Calls generate_content, retrying transient errors with jittered exponential backoff."""
+    for attempt in range(1, RETRY_ATTEMPTS + 1):
+        limiter.wait()
+        try:
+            return model.generate_content(
+                parts,
+                safety_settings=safety_settings,
+                generation_config=generation_config
+            )
+        except RETRYABLE_ERRORS as e:
+            if attempt == RETRY_ATTEMPTS:
+                raise
+            delay = random.uniform(RETRY_MIN_WAIT, min(RETRY_MAX_WAIT, RETRY_MIN_WAIT * 2 ** attempt))
+            tqdm.write(f"  {type(e).__name__}, retrying in {delay:.1f}s (attempt {attempt}/{RETRY_ATTEMPTS})")
+            time.sleep(delay)